@@ -12,10 +12,70 @@ import re
 import collections
 import argparse
 import sys
+import pickle
+import threading
+import mmap
+import bisect
+import struct
+import gzip
+import hashlib
+import heapq
+import itertools
+import tempfile
+import json
+import zlib
+import multiprocessing
+from array import array
+from multiprocessing.pool import ThreadPool
+
+try:
+    from collections.abc import Mapping
+except ImportError as e:
+    from collections import Mapping
+
+try:
+    import sqlite3
+except ImportError as e:
+    sqlite3 = None
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+
+try:
+    from sys import intern
+except ImportError as e:
+    from __builtin__ import intern
+
+# sqlite hands back text as unicode on python 2
+try:
+    _text = unicode
+except NameError as e:
+    _text = str
+
+# Typecode of 64 bit integer arrays. Python 2 has no 'q' but its 'l' is 64
+# bits on 64 bit unix
+try:
+    array('q')
+    _int64 = 'q'
+except ValueError as e:
+    _int64 = 'l'
+
+def _native_str(data):
+    '''
+    Return utf-8 bytes as the native str type(bytes on python 2)
+    '''
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8')
 
 __version__ = '0.0.1-dev'
 
 class DmpLine(object):
+    # columns with only a handful of distinct values
+    categorical_headers = ()
+
     def __init__(self, dmpline):
         if isinstance(dmpline, str):
             self.parse(dmpline, self.headers)
@@ -30,10 +90,30 @@ class DmpLine(object):
                 len(headers),
                 len(parseddmpline)
             ))
+        categorical = self.categorical_headers
         for hdr, value in zip(headers,parseddmpline):
+            # Share one string object for every repeat of a categorical value
+            if hdr in categorical and isinstance(value, str):
+                value = intern(value)
             setattr(self, hdr, value)
 
+    def values(self):
+        '''
+        Returns the parsed values in the same order as headers
+        '''
+        return [getattr(self, hdr) for hdr in self.headers]
+
+    def format(self):
+        '''
+        Returns the values as a line in .dmp file format
+        '''
+        return format_dmpline(self.values())
+
     def parse(self, dmpline, headers):
+        # Every line is terminated by \t| so drop it before splitting
+        dmpline = dmpline.rstrip('\r\n')
+        if dmpline.endswith('\t|'):
+            dmpline = dmpline[:-2]
         splitline = re.split('\t\|\t', dmpline)
         if splitline[0] == '' and len(splitline) == 1:
             splitline = []
@@ -55,6 +135,13 @@ class Node(DmpLine):
         'hidden_subtree_root_flag', # (1 or 0) 1 if this subtree has no sequence data yet
         'comments', # free-text comments and citations     
     )
+    # columns that hold integer ids
+    int_headers = ('id', 'parent_id', 'division')
+    categorical_headers = (
+        'rank', 'embl_code', 'inherited_div_flag', 'genetic_code_id',
+        'inherited_ GC_flag', 'mitochondrial_genetic_code_id',
+        'inherited_MGC_flag', 'GenBank_hidden_flag', 'hidden_subtree_root_flag',
+    )
 
 class Name(DmpLine):
     headers = (
@@ -63,6 +150,8 @@ class Name(DmpLine):
         'unique_name', # the unique variant of this name if name not unique    
         'name_class', # (synonym, common name, ...)            
     )
+    int_headers = ('id',)
+    categorical_headers = ('name_class',)
 
 class Division(DmpLine):
     headers = (
@@ -71,6 +160,14 @@ class Division(DmpLine):
         'name', # e.g. BCT, PLN, VRT, MAM, PRI...                   
         'comments'
     )
+    int_headers = ('id',)
+    categorical_headers = ('code',)
+
+def format_dmpline(values):
+    '''
+    Join values into a single .dmp line including the line terminator
+    '''
+    return '\t|\t'.join(values) + '\t|\n'
 
 classmap = {
     'Node': Node,
@@ -78,6 +175,29 @@ classmap = {
     'Division': Division,
 }
 
+def _dmpclass(dmptype):
+    klass = classmap.get(dmptype, None)
+    if klass is None:
+        raise ValueError('{0} is not a valid dmptype'.format(dmptype))
+    return klass
+
+def _iter_dmpfile(input_f, klass):
+    handle = input_f
+    if isinstance(handle, str):
+        handle = open(handle)
+    with handle as fh:
+        for dmpline in fh:
+            yield klass(dmpline)
+
+def iter_dmpfile(input_f, dmptype):
+    '''
+    Yield each parsed line of a .dmp file in file order
+
+    :param str input_f: File handle or filepath to input .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    return _iter_dmpfile(input_f, _dmpclass(dmptype))
+
 def index_dmpfile(input_f, dmptype):
     '''
     Simply return a dictionary keyed by the id of each of the parsed lines.
@@ -87,62 +207,745 @@ def index_dmpfile(input_f, dmptype):
     :param str input_f: File handle or filepath to input .dmp file
     :param str dmptype: one of classmap's keys
     '''
-    dmptype = classmap.get(dmptype, None)
-    if dmptype is None:
-        raise ValueError('{0} is not a valid dmptype'.format(dmptype))
-    handle = input_f
-    if isinstance(handle, str):
-        handle = open(handle)
     index = collections.defaultdict(list)
-    with handle as fh:
-        for dmpline in fh:
-            entry = dmptype(dmpline)
-            index[entry.id].append(entry)
+    for entry in iter_dmpfile(input_f, dmptype):
+        index[entry.id].append(entry)
     return index
 
+class StringHeap(object):
+    '''
+    Deduplicated store of strings kept as utf-8 in one contiguous bytes heap.
+    Each distinct string gets an integer id and offsets[id]:offsets[id+1] is
+    its slice of the heap. Strings can only be added until freeze is called.
+    '''
+    def __init__(self):
+        self.offsets = array(_int64, [0])
+        self._heap = bytearray()
+        self._ids = {}
+        self.heap = None
+
+    def add(self, value):
+        '''
+        Return the id of value, adding it to the heap if it is new
+        '''
+        stringid = self._ids.get(value)
+        if stringid is None:
+            stringid = len(self.offsets) - 1
+            self._heap += value.encode('utf-8')
+            self.offsets.append(len(self._heap))
+            self._ids[value] = stringid
+        return stringid
+
+    def freeze(self):
+        '''
+        Drop the lookup table used for deduplication and make the heap
+        immutable
+        '''
+        self.heap = bytes(self._heap)
+        self._heap = None
+        self._ids = None
+
+    def copy(self):
+        '''
+        Return a heap that new strings can be added to holding the same
+        strings under the same ids. New strings are not deduplicated against
+        the existing ones.
+        '''
+        heap = StringHeap()
+        heap.offsets = array(self.offsets.typecode, self.offsets)
+        heap._heap = bytearray(
+            self.heap if self.heap is not None else self._heap
+        )
+        return heap
+
+    def __getitem__(self, stringid):
+        heap = self.heap if self.heap is not None else self._heap
+        return _native_str(
+            heap[self.offsets[stringid]:self.offsets[stringid + 1]]
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class CompactDmpIndex(Mapping):
+    '''
+    Read only index of a .dmp file that stores columns instead of DmpLine
+    objects. Integer columns(int_headers) are kept in arrays, categorical
+    columns(categorical_headers) as small integer codes into a list of their
+    distinct values and every other column as ids into a single StringHeap.
+    DmpLine objects are only created for the lines that are looked up.
+
+    :param str input_f: File handle or filepath to input .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    def __init__(self, input_f, dmptype):
+        self.dmpclass = _dmpclass(dmptype)
+        self.dmptype = dmptype
+        self._build(iter_dmpfile(input_f, dmptype))
+
+    @classmethod
+    def from_entries(cls, entries, dmptype):
+        '''
+        Build a CompactDmpIndex from an iterable of DmpLine objects instead
+        of a .dmp file
+
+        :param iterable entries: DmpLine(or DmpLine like) objects
+        :param str dmptype: one of classmap's keys
+        '''
+        inst = cls.__new__(cls)
+        inst.dmpclass = _dmpclass(dmptype)
+        inst.dmptype = dmptype
+        inst._build(entries)
+        return inst
+
+    def _build(self, entries):
+        klass = self.dmpclass
+        self.strings = StringHeap()
+        self.columns = {}
+        self.categories = {}
+        for hdr in klass.headers:
+            if hdr in klass.int_headers:
+                self.columns[hdr] = array(_int64)
+            elif hdr in klass.categorical_headers:
+                self.columns[hdr] = array('H')
+                self.categories[hdr] = []
+            else:
+                self.columns[hdr] = array('l')
+        append = self._appender()
+        for entry in entries:
+            append(entry)
+        self.strings.freeze()
+        ids = self.columns['id']
+        if any(ids[i] > ids[i+1] for i in range(len(ids) - 1)):
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            for hdr, column in list(self.columns.items()):
+                self.columns[hdr] = array(
+                    column.typecode, (column[i] for i in order)
+                )
+        self.ids = self.columns['id']
+        self._len = len(set(self.ids))
+
+    def _appender(self):
+        '''
+        Return a function that encodes an entry onto the end of the columns
+        '''
+        klass = self.dmpclass
+        codes = dict(
+            (hdr, dict((value, code) for code, value in enumerate(values)))
+            for hdr, values in self.categories.items()
+        )
+        columns = [(hdr, self.columns[hdr]) for hdr in klass.headers]
+        def append(entry):
+            for hdr, column in columns:
+                value = getattr(entry, hdr)
+                if hdr in codes:
+                    code = codes[hdr].get(value)
+                    if code is None:
+                        code = len(self.categories[hdr])
+                        if code > 0xffff:
+                            raise ValueError(
+                                'too many distinct values for {0}'.format(hdr)
+                            )
+                        codes[hdr][value] = code
+                        self.categories[hdr].append(value)
+                    column.append(code)
+                elif hdr in klass.int_headers:
+                    column.append(int(value))
+                else:
+                    column.append(self.strings.add(value))
+        return append
+
+    def patched(self, changes):
+        '''
+        Return a new CompactDmpIndex with the lines of every id in changes
+        replaced by changes[id](an empty list removes the id). Unchanged rows
+        are copied a slice at a time so only the changed lines are encoded.
+
+        :param dict changes: id to list of DmpLine objects
+        '''
+        inst = CompactDmpIndex.__new__(CompactDmpIndex)
+        inst.dmpclass = self.dmpclass
+        inst.dmptype = self.dmptype
+        inst.strings = self.strings.copy()
+        inst.categories = dict(
+            (hdr, list(values)) for hdr, values in self.categories.items()
+        )
+        inst.columns = dict(
+            (hdr, array(column.typecode))
+            for hdr, column in self.columns.items()
+        )
+        append = inst._appender()
+        start = 0
+        for key in sorted(changes, key=int):
+            lo, hi = self._rows(key)
+            for hdr, column in inst.columns.items():
+                column.extend(self.columns[hdr][start:lo])
+            for entry in changes[key]:
+                append(entry)
+            start = hi
+        for hdr, column in inst.columns.items():
+            column.extend(self.columns[hdr][start:])
+        inst.strings.freeze()
+        inst.ids = inst.columns['id']
+        inst._len = len(set(inst.ids))
+        return inst
+
+    def _value(self, hdr, row):
+        value = self.columns[hdr][row]
+        if hdr in self.categories:
+            return self.categories[hdr][value]
+        if hdr in self.dmpclass.int_headers:
+            return str(value)
+        return self.strings[value]
+
+    def _rows(self, key):
+        try:
+            key = int(key)
+        except (TypeError, ValueError) as e:
+            return 0, 0
+        lo = bisect.bisect_left(self.ids, key)
+        hi = bisect.bisect_right(self.ids, key, lo)
+        return lo, hi
+
+    def __getitem__(self, key):
+        lo, hi = self._rows(key)
+        if lo == hi:
+            raise KeyError(key)
+        headers = self.dmpclass.headers
+        return [
+            self.dmpclass([self._value(hdr, row) for hdr in headers])
+            for row in range(lo, hi)
+        ]
+
+    def __contains__(self, key):
+        lo, hi = self._rows(key)
+        return lo != hi
+
+    def __iter__(self):
+        last = None
+        for taxid in self.ids:
+            if taxid != last:
+                yield str(taxid)
+                last = taxid
+
+    def __len__(self):
+        return self._len
+
+def compact_index_dmpfile(input_f, dmptype):
+    '''
+    Same as index_dmpfile but returns a CompactDmpIndex
+
+    :param str input_f: File handle or filepath to input .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    return CompactDmpIndex(input_f, dmptype)
+
+def to_compact_index(index, dmptype):
+    '''
+    Return index as a CompactDmpIndex holding its data. Any other index
+    (dictionary, mmap, sidecar or array backed) is copied entry by entry.
+
+    :param Mapping index: index to convert
+    :param str dmptype: one of classmap's keys
+    '''
+    if isinstance(index, CompactDmpIndex):
+        return index
+    return CompactDmpIndex.from_entries(
+        (entry for taxid in index for entry in index[taxid]), dmptype
+    )
+
+class _MmapRow(object):
+    '''
+    A single line of a MmapDmpIndex. Integer columns come straight from the
+    index arrays and the line is only decoded and parsed when one of the
+    other columns is accessed.
+    '''
+    __slots__ = ('_index', '_row', '_entry')
+
+    def __init__(self, index, row):
+        self._index = index
+        self._row = row
+        self._entry = None
+
+    @property
+    def headers(self):
+        return self._index.dmpclass.headers
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        column = self._index.columns.get(attr)
+        if column is not None:
+            return str(column[self._row])
+        entry = self._entry
+        if entry is None:
+            entry = self._index.dmpclass(self._index.line(self._row))
+            self._entry = entry
+        return getattr(entry, attr)
+
+    def values(self):
+        return [getattr(self, hdr) for hdr in self.headers]
+
+    def format(self):
+        return format_dmpline(self.values())
+
+    def __reduce__(self):
+        return self._index.dmpclass, (self.values(),)
+
+class MmapDmpIndex(Mapping):
+    '''
+    Read only index of a .dmp file that is memory mapped instead of read.
+
+    Lines are located by scanning the raw bytes for the line and column
+    delimiters and only the integer columns of each line(see int_headers)
+    are parsed up front into arrays. Lookups return _MmapRow objects in
+    place of DmpLine objects which decode the rest of the line on demand.
+
+    :param str input_f: filepath or binary file handle of a .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    def __init__(self, input_f, dmptype):
+        self.dmpclass = _dmpclass(dmptype)
+        self.dmptype = dmptype
+        self.path = getattr(input_f, 'name', input_f)
+        handle = input_f
+        if isinstance(handle, str):
+            handle = open(handle, 'rb')
+        with handle as fh:
+            if os.fstat(fh.fileno()).st_size:
+                self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mm = b''
+        self._scan()
+
+    def _scan(self):
+        headers = self.dmpclass.headers
+        positions = [headers.index(hdr) for hdr in self.dmpclass.int_headers]
+        lastcolumn = max(positions)
+        arrays = [array(_int64) for hdr in positions]
+        starts = array(_int64)
+        mm = self._mm
+        pos = 0
+        if len(mm):
+            mm.seek(0)
+            # Only split as far as the last integer column that is needed
+            for dmpline in iter(mm.readline, b''):
+                fields = dmpline.split(b'\t|\t', lastcolumn + 1)
+                if len(fields) > lastcolumn:
+                    for arr, position in zip(arrays, positions):
+                        arr.append(int(fields[position]))
+                    starts.append(pos)
+                elif dmpline.strip():
+                    raise ValueError('Invalid dmpline encountered {0}'.format(
+                        dmpline
+                    ))
+                pos += len(dmpline)
+        ids = arrays[0]
+        if any(ids[i] > ids[i+1] for i in range(len(ids) - 1)):
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            arrays = [array(_int64, (arr[i] for i in order)) for arr in arrays]
+            starts = array(_int64, (starts[i] for i in order))
+        self.columns = dict(zip(self.dmpclass.int_headers, arrays))
+        self.ids = self.columns['id']
+        self.starts = starts
+        self._len = len(set(self.ids))
+
+    def line(self, row):
+        '''
+        Return the decoded text of row
+        '''
+        start = self.starts[row]
+        end = self._mm.find(b'\n', start)
+        if end == -1:
+            end = len(self._mm)
+        return _native_str(self._mm[start:end])
+
+    def _rows(self, key):
+        try:
+            key = int(key)
+        except (TypeError, ValueError) as e:
+            return 0, 0
+        lo = bisect.bisect_left(self.ids, key)
+        hi = bisect.bisect_right(self.ids, key, lo)
+        return lo, hi
+
+    def __getitem__(self, key):
+        lo, hi = self._rows(key)
+        if lo == hi:
+            raise KeyError(key)
+        return [_MmapRow(self, row) for row in range(lo, hi)]
+
+    def __contains__(self, key):
+        lo, hi = self._rows(key)
+        return lo != hi
+
+    def __iter__(self):
+        last = None
+        for taxid in self.ids:
+            if taxid != last:
+                yield str(taxid)
+                last = taxid
+
+    def __len__(self):
+        return self._len
+
+    def __reduce__(self):
+        # mmaps cannot be pickled so the file is mapped again
+        return MmapDmpIndex, (self.path, self.dmptype)
+
+def mmap_index_dmpfile(input_f, dmptype):
+    '''
+    Same as index_dmpfile but returns a MmapDmpIndex
+
+    :param str input_f: filepath or binary file handle of a .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    return MmapDmpIndex(input_f, dmptype)
+
+# Sidecar header: magic, version, dmp size, dmp mtime in nanoseconds,
+# number of unique ids
+_sidecar_header = struct.Struct('<4sIqqq')
+# Sidecar record: taxid, byte offset of the line in the dmp file
+_sidecar_record = struct.Struct('<qq')
+_sidecar_magic = b'BTXO'
+_sidecar_version = 2
+
+def sidecar_path(dmppath):
+    return dmppath + '.offsets'
+
+def sidecar_cache_path(dmppath):
+    '''
+    Path of dmppath's sidecar in the user's cache directory, used when the
+    directory of dmppath is not writable
+    '''
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache'
+    )
+    name = hashlib.sha1(os.path.abspath(dmppath).encode('utf-8')).hexdigest()
+    return os.path.join(cachedir, 'blasttax', name + '.offsets')
+
+def _dmp_signature(dmppath):
+    st = os.stat(dmppath)
+    # st_mtime_ns is missing before python 3.3
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 10 ** 9)
+    return st.st_size, mtime
+
+def build_sidecar(dmppath, path=None):
+    '''
+    Write a sidecar file that maps every taxid to the byte offset of each of
+    its lines. Records are sorted by taxid so they can be binary searched.
+    Returns the path to the sidecar.
+
+    :param str dmppath: path to .dmp file
+    :param str path: path to write sidecar to[Default: next to dmppath]
+    '''
+    records = []
+    offset = 0
+    with open(dmppath, 'rb') as fh:
+        for dmpline in fh:
+            if dmpline.strip():
+                taxid = int(dmpline.split(b'\t|\t', 1)[0])
+                records.append((taxid, offset))
+            offset += len(dmpline)
+    records.sort()
+    unique = len(set(taxid for taxid, offset in records))
+    size, mtime = _dmp_signature(dmppath)
+    if path is None:
+        path = sidecar_path(dmppath)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as fh:
+        fh.write(_sidecar_header.pack(
+            _sidecar_magic, _sidecar_version, size, mtime, unique
+        ))
+        for record in records:
+            fh.write(_sidecar_record.pack(*record))
+    os.rename(tmppath, path)
+    return path
+
+def _read_sidecar_header(dmppath, path):
+    '''
+    Return the unpacked header of dmppath's sidecar at path or None if the
+    sidecar is missing or out of date
+    '''
+    try:
+        with open(path, 'rb') as fh:
+            header = _sidecar_header.unpack(fh.read(_sidecar_header.size))
+    except (IOError, OSError, struct.error) as e:
+        return None
+    magic, version, size, mtime, unique = header
+    if magic != _sidecar_magic or version != _sidecar_version:
+        return None
+    if (size, mtime) != _dmp_signature(dmppath):
+        return None
+    return header
+
+def _open_sidecar(dmppath):
+    '''
+    Return the path and header of an up to date sidecar for dmppath. The
+    sidecar is built next to dmppath or, if that directory is not writable,
+    in the user's cache directory.
+    '''
+    paths = (sidecar_path(dmppath), sidecar_cache_path(dmppath))
+    for path in paths:
+        header = _read_sidecar_header(dmppath, path)
+        if header is not None:
+            return path, header
+    try:
+        path = build_sidecar(dmppath, paths[0])
+    except (IOError, OSError) as e:
+        cachedir = os.path.dirname(paths[1])
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        path = build_sidecar(dmppath, paths[1])
+    return path, _read_sidecar_header(dmppath, path)
+
+class SidecarDmpIndex(Mapping):
+    '''
+    Read only index of a .dmp file that seeks straight to the lines of a
+    taxid using the byte offsets in its sidecar file(see build_sidecar).
+    Nothing but the sidecar header is read up front so looking up a single
+    lineage only parses the lines of that lineage.
+
+    The sidecar is built if it is missing or older than the .dmp file(see
+    _open_sidecar for where it is kept).
+
+    :param str dmppath: path to .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    def __init__(self, dmppath, dmptype):
+        self.dmpclass = _dmpclass(dmptype)
+        self.dmptype = dmptype
+        self.path = dmppath
+        self.sidecar, header = _open_sidecar(dmppath)
+        self._len = header[-1]
+        # Mapped so that a lookup only pages in the records it touches
+        with open(self.sidecar, 'rb') as fh:
+            self._offsets = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._count = (
+            (len(self._offsets) - _sidecar_header.size) // _sidecar_record.size
+        )
+        # Lines are sliced out of a map of the .dmp file rather than read
+        # through a shared handle whose position threads and forked
+        # processes would race on
+        with open(dmppath, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size:
+                self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mm = b''
+
+    def _record(self, i):
+        return _sidecar_record.unpack_from(
+            self._offsets, _sidecar_header.size + i * _sidecar_record.size
+        )
+
+    def _search(self, taxid):
+        '''
+        Return the index of the first record whose taxid is not less than
+        taxid
+        '''
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < taxid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _line_offsets(self, key):
+        try:
+            taxid = int(key)
+        except (TypeError, ValueError) as e:
+            return []
+        offsets = []
+        i = self._search(taxid)
+        while i < self._count:
+            recid, offset = self._record(i)
+            if recid != taxid:
+                break
+            offsets.append(offset)
+            i += 1
+        return offsets
+
+    def __getitem__(self, key):
+        offsets = self._line_offsets(key)
+        if not offsets:
+            raise KeyError(key)
+        return [self.dmpclass(self._line(offset)) for offset in offsets]
+
+    def _line(self, offset):
+        end = self._mm.find(b'\n', offset)
+        if end == -1:
+            end = len(self._mm)
+        else:
+            end += 1
+        return _native_str(self._mm[offset:end])
+
+    def __contains__(self, key):
+        offsets = self._line_offsets(key)
+        return bool(offsets)
+
+    def __iter__(self):
+        last = None
+        for i in range(self._count):
+            taxid = self._record(i)[0]
+            if taxid != last:
+                yield str(taxid)
+                last = taxid
+
+    def __len__(self):
+        return self._len
+
+    def close(self):
+        self._offsets.close()
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+
+    def __reduce__(self):
+        return SidecarDmpIndex, (self.path, self.dmptype)
+
+def sidecar_index_dmpfile(dmppath, dmptype):
+    '''
+    Same as index_dmpfile but returns a SidecarDmpIndex
+
+    :param str dmppath: path to .dmp file
+    :param str dmptype: one of classmap's keys
+    '''
+    return SidecarDmpIndex(dmppath, dmptype)
+
+def _unpickle_phylo(lineage, indexes):
+    phylo = Phylo.__new__(Phylo)
+    object.__setattr__(phylo, 'lineage', lineage)
+    object.__setattr__(phylo, '_indexes', indexes)
+    object.__setattr__(phylo, '_ranks', None)
+    return phylo
+
 class Phylo(object):
+    '''
+    Phylogony of a single taxid.
+
+    Only the tuple of taxids from taxid up to(but not including) the root
+    named 'all' is stored. Names, ranks and the string form are looked up in
+    the indexes when they are needed. Phylo objects are immutable, hash and
+    compare by lineage and pickle with just the index entries of their
+    lineage.
+    '''
+    __slots__ = ('lineage', '_indexes', '_ranks')
+
     def __init__(self, taxid, nameindex, nodeindex, divindex):
-        self.nameindex = nameindex
-        self.nodeindex = nodeindex
-        self.divindex = divindex
-        self.taxid = taxid
-        if self.taxid not in nameindex:
+        if taxid not in nameindex:
             raise ValueError('taxid {0} is missing from nameindex'.format(
-                self.taxid
+                taxid
             ))
-        if self.taxid not in nodeindex:
+        if taxid not in nodeindex:
             raise ValueError('taxid {0} is missing from nodeindex'.format(
-                self.taxid
+                taxid
             ))
-    
+        object.__setattr__(self, '_indexes', (nameindex, nodeindex, divindex))
+        object.__setattr__(self, '_ranks', None)
+        object.__setattr__(self, 'lineage', self._build_lineage(taxid))
+
     def __getattr__(self, attr):
-        if attr not in self.__dict__:
-            self._build_phylogony(self.taxid)
-        try:
-            return self.__dict__[attr]
-        except KeyError as e:
-            raise AttributeError('Phylo object has no attribute \'{0}\''.format(
-                attr
-            ))
+        if not attr.startswith('_'):
+            ranks = self.ranks
+            if attr in ranks:
+                return ranks[attr]
+        raise AttributeError('Phylo object has no attribute \'{0}\''.format(
+            attr
+        ))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('Phylo objects are immutable')
+
+    def __delattr__(self, attr):
+        raise AttributeError('Phylo objects are immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Phylo):
+            return NotImplemented
+        return self.lineage == other.lineage
+
+    def __ne__(self, other):
+        if not isinstance(other, Phylo):
+            return NotImplemented
+        return self.lineage != other.lineage
 
-    def _build_phylogony(self, taxid):
+    def __hash__(self):
+        return hash(self.lineage)
+
+    def __reduce__(self):
+        nameindex, nodeindex, divindex = {}, {}, {}
+        for names, node, div in self._entries(self.lineage):
+            nameindex[node.id] = names
+            nodeindex[node.id] = [node]
+            divindex[node.division] = div
+        return _unpickle_phylo, (self.lineage, (nameindex, nodeindex, divindex))
+
+    @property
+    def taxid(self):
+        return self.lineage[0]
+
+    @property
+    def nameindex(self):
+        return self._indexes[0]
+
+    @property
+    def nodeindex(self):
+        return self._indexes[1]
+
+    @property
+    def divindex(self):
+        return self._indexes[2]
+
+    @property
+    def phylo(self):
+        '''
+        List of (names, node, division) tuples for each taxid in lineage
+        '''
+        return list(self._entries(self.lineage))
+
+    @property
+    def names(self):
+        '''
+        Tuple of the first name of each taxid in lineage
+        '''
+        return tuple(names[0].name for names, node, div in self._entries(self.lineage))
+
+    @property
+    def ranks(self):
         '''
-        From a given taxid build the full phylogony
+        Dictionary of rank to the list of names for that rank. When a rank is
+        present multiple times in the lineage the one closest to the root wins
+        '''
+        ranks = self._ranks
+        if ranks is None:
+            ranks = {}
+            for names, node, div in self._entries(self.lineage):
+                if names[0].name != 'all':
+                    ranks[node.rank] = self._get_attrs_for_(names, 'name')
+            object.__setattr__(self, '_ranks', ranks)
+        return ranks
+
+    def _build_lineage(self, taxid):
+        '''
+        From a given taxid build the tuple of taxids up to the root
         The taxid will be recursively looked up in the nodes/names
         '''
-        # Only build phylogony once
-        if 'phylo' not in self.__dict__:
-            self.__dict__['phylo'] = []
-        else:
-            return
+        lineage = [taxid]
         curnames, curnode, curdiv = self._get_name_node_div(taxid)
-        self.phylo.append((curnames, curnode, curdiv))
         while curnames[0].name != 'all':
-            names = self._get_attrs_for_(curnames, 'name')
-            setattr(self, curnode.rank, names)
             curnames, curnode, curdiv = self._get_name_node_div(curnode.parent_id)
             if curnames[0].name != 'all':
-                self.phylo.append((curnames, curnode, curdiv))
+                lineage.append(curnode.id)
+            if len(lineage) > len(self.nodeindex):
+                raise ValueError('cycle detected above taxid {0}'.format(taxid))
+        return tuple(lineage)
+
+    def _entries(self, taxids):
+        for taxid in taxids:
+            yield self._get_name_node_div(taxid)
 
     def _get_attrs_for_(self, objs, attr):
         '''
@@ -159,66 +962,2424 @@ class Phylo(object):
         Looks up name, node and div in each of the indexes for the taxid
         and returns them all
         '''
-        name = self.nameindex[taxid]
-        node = self.nodeindex[taxid][0]
+        nameindex, nodeindex, divindex = self._indexes
+        # Use get so that defaultdict indexes are never modified by a lookup
+        name = nameindex.get(taxid)
+        nodes = nodeindex.get(taxid)
+        if not name or not nodes:
+            raise ValueError('taxid {0} is missing from the indexes'.format(
+                taxid
+            ))
+        node = nodes[0]
         divid = node.division
-        div = self.divindex[divid]
+        div = divindex.get(divid, [])
         return name, node, div
 
     def __str__(self):
         phylo = []
-        for names, node, div in self.phylo:
+        for names, node, div in self._entries(self.lineage):
             _str = '{0}({1})'.format(names[0].name, node.rank)
             phylo.append(_str)
         return ' -> '.join(phylo)
 
-class Phylogony(object):
-    def __init__(self, namefh, nodefh, divfh):
-        self.namefh = namefh
-        self.nodefh = nodefh
-        self.divfh = divfh
+def _node_columns(nodeindex):
+    '''
+    Yield (id, parent_id, division) of the first line of every node. Indexes
+    that keep these columns as arrays(CompactDmpIndex, MmapDmpIndex and the
+    array index of Phylogony.from_arrays) are read without building any Node
+    objects.
 
-    def _build_indexes(self):
-        if not hasattr(self, 'nameindex'):
-            self.nameindex = index_dmpfile(self.namefh, 'Name')
-        if not hasattr(self, 'nodeindex'):
-            self.nodeindex = index_dmpfile(self.nodefh, 'Node')
-        if not hasattr(self, 'divindex'):
-            self.divindex = index_dmpfile(self.divfh, 'Division')
+    :param dict nodeindex: index of Node objects
+    '''
+    columns = getattr(nodeindex, 'columns', None)
+    if columns is None:
+        for taxid, nodes in nodeindex.items():
+            yield taxid, nodes[0].parent_id, nodes[0].division
+        return
+    last = None
+    for taxid, parent_id, division in zip(
+            columns['id'].tolist(), columns['parent_id'].tolist(),
+            columns['division'].tolist()):
+        # Rows are sorted by id so only the first row of an id is used
+        if taxid != last:
+            yield str(taxid), str(parent_id), str(division)
+            last = taxid
 
-    def __getitem__(self, key):
-        self._build_indexes()
-        try:
-            return Phylo(key, self.nameindex, self.nodeindex, self.divindex)
-        except ValueError as e:
-            raise KeyError(str(e))
+def parent_ids(nodeindex):
+    '''
+    Return a dictionary of node id to parent id
 
-def main():
-    args = parse_args()
-    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
-    sys.stdout.write(str(p[args.taxid]) + '\n')
+    :param dict nodeindex: index of Node objects
+    '''
+    return dict(
+        (taxid, parent_id) for taxid, parent_id, division in
+        _node_columns(nodeindex)
+    )
 
-def parse_args():
-    parser = argparse.ArgumentParser()
+def build_children(nodeindex, parents=None):
+    '''
+    Return a dictionary keyed by node id whose values are the list of child
+    node ids. Root nodes(nodes that are their own parent) are not listed as
+    their own child.
 
-    parser.add_argument(
-        'namedmp',
-        help='names.dmp file'
-    )
+    :param dict nodeindex: index of Node objects from index_dmpfile
+    :param dict parents: parent_ids(nodeindex) if already computed
+    '''
+    if parents is None:
+        parents = parent_ids(nodeindex)
+    children = collections.defaultdict(list)
+    for taxid, parent_id in parents.items():
+        if parent_id != taxid:
+            children[parent_id].append(taxid)
+    return children
 
-    parser.add_argument(
-        'nodedmp',
-        help='nodes.dmp file'
-    )
+def _is_root(taxid, nodeindex):
+    parent_id = nodeindex[taxid][0].parent_id
+    return parent_id == taxid or parent_id not in nodeindex
 
-    parser.add_argument(
-        'divisiondmp',
-        help='division.dmp'
-    )
+def _walk_depth(taxid, nodeindex):
+    '''
+    Count the number of edges between taxid and its root by walking the
+    parent ids. Raises ValueError if the walk does not terminate.
+    '''
+    depth = 0
+    while not _is_root(taxid, nodeindex):
+        taxid = nodeindex[taxid][0].parent_id
+        depth += 1
+        if depth > len(nodeindex):
+            raise ValueError('cycle detected above taxid {0}'.format(taxid))
+    return depth
 
-    parser.add_argument(
-        'taxid',
-        help='taxid to lookup phylogony for'
-    )
+def update_depths(nodeindex, children, taxids, depths):
+    '''
+    Recompute the depth of each of taxids and everything beneath them,
+    updating depths in place. Only the given subtrees are visited.
+
+    :param dict nodeindex: index of Node objects
+    :param dict children: child map from build_children
+    :param iterable taxids: roots of the subtrees to recompute
+    :param dict depths: depth map to update
+    '''
+    done = set()
+    for taxid in taxids:
+        if taxid in done or taxid not in nodeindex:
+            continue
+        stack = [(taxid, _walk_depth(taxid, nodeindex))]
+        while stack:
+            curid, depth = stack.pop()
+            depths[curid] = depth
+            done.add(curid)
+            for childid in children.get(curid, ()):
+                stack.append((childid, depth + 1))
+    return depths
+
+def compute_depths(nodeindex, children, parents=None):
+    '''
+    Return a dictionary of node id to the number of edges between that node
+    and its root. Nodes that cannot reach a root(cycles) are left out.
 
-    return parser.parse_args()
+    :param dict nodeindex: index of Node objects
+    :param dict children: child map from build_children
+    :param dict parents: parent_ids(nodeindex) if already computed
+    '''
+    if parents is None:
+        parents = parent_ids(nodeindex)
+    depths = {}
+    stack = [
+        (taxid, 0) for taxid, parent_id in parents.items()
+        if parent_id == taxid or parent_id not in parents
+    ]
+    while stack:
+        taxid, depth = stack.pop()
+        depths[taxid] = depth
+        for childid in children.get(taxid, ()):
+            stack.append((childid, depth + 1))
+    return depths
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('numpy is required for array import/export')
+
+class _ArrayIndex(Mapping):
+    '''
+    Read only index over the sorted taxid array of Phylogony.to_arrays.
+    Subclasses build the DmpLine objects for a row in _entries.
+    '''
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.ids = arrays['taxid']
+
+    def _row(self, key):
+        try:
+            key = int(key)
+        except (TypeError, ValueError) as e:
+            return None
+        row = int(numpy.searchsorted(self.ids, key))
+        if row < len(self.ids) and self.ids[row] == key:
+            return row
+        return None
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        return self._entries(row)
+
+    def __contains__(self, key):
+        return self._row(key) is not None
+
+    def __iter__(self):
+        for taxid in self.ids:
+            yield str(taxid)
+
+    def __len__(self):
+        return len(self.ids)
+
+class _ArrayNodeIndex(_ArrayIndex):
+    @property
+    def columns(self):
+        return {
+            'id': self.ids,
+            'parent_id': self.arrays['parent'],
+            'division': self.arrays['division'],
+        }
+
+    def _entries(self, row):
+        values = [''] * len(Node.headers)
+        values[0] = str(self.ids[row])
+        values[1] = str(self.arrays['parent'][row])
+        values[2] = str(self.arrays['rank_labels'][self.arrays['rank'][row]])
+        values[4] = str(self.arrays['division'][row])
+        return [Node(values)]
+
+class _ArrayNameIndex(_ArrayIndex):
+    def _entries(self, row):
+        offsets = self.arrays['name_offsets']
+        name = self.arrays['name_heap'][offsets[row]:offsets[row + 1]]
+        taxid = str(self.ids[row])
+        names = [Name([taxid, _native_str(name.tobytes()), '', 'scientific name'])]
+        # Phylo stops at the root named all so roots keep that name first
+        if self.ids[row] == self.arrays['parent'][row]:
+            names.insert(0, Name([taxid, 'all', '', 'synonym']))
+        return names
+
+def _scientific_name(names):
+    for name in names:
+        if name.name_class == 'scientific name':
+            return name.name
+    return names[0].name if names else ''
+
+def lookup_many(phylogony, taxids, threads=None):
+    '''
+    Look up many taxids at once using a pool of threads. Returns a list of
+    Phylo objects in the same order as taxids with None for every taxid that
+    could not be found.
+
+    :param Phylogony phylogony: Phylogony or SqlitePhylogony to look up in
+    :param iterable taxids: taxids to look up
+    :param int threads: number of threads to use[Default: cpu count]
+    '''
+    def lookup(taxid):
+        try:
+            return phylogony[taxid]
+        except KeyError as e:
+            return None
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(lookup, taxids)
+    finally:
+        pool.close()
+        pool.join()
+
+class Phylogony(object):
+    # Bumped whenever the layout of a compiled index changes
+    index_version = 2
+
+    def __init__(self, namefh, nodefh, divfh, indexer=None):
+        '''
+        :param str namefh: File handle or filepath to names.dmp
+        :param str nodefh: File handle or filepath to nodes.dmp
+        :param str divfh: File handle or filepath to division.dmp
+        :param callable indexer: function used to index each dmp file.
+            index_dmpfile(the default), mmap_index_dmpfile,
+            sidecar_index_dmpfile or compact_index_dmpfile
+        '''
+        self.namefh = namefh
+        self.nodefh = nodefh
+        self.divfh = divfh
+        self.indexer = indexer
+        # Guards building the indexes so only one thread ever parses
+        self._lock = threading.RLock()
+        self._indexes_built = False
+        self._tree_built = False
+        self._jumps_built = False
+
+    def _build_indexes(self):
+        if self._indexes_built:
+            return
+        with self._lock:
+            indexer = self.indexer or index_dmpfile
+            if not hasattr(self, 'nameindex'):
+                self.nameindex = indexer(self.namefh, 'Name')
+            if not hasattr(self, 'nodeindex'):
+                self.nodeindex = indexer(self.nodefh, 'Node')
+            if not hasattr(self, 'divindex'):
+                self.divindex = indexer(self.divfh, 'Division')
+            self._indexes_built = True
+
+    def _build_tree(self):
+        '''
+        Build the data derived from the nodeindex(child map and depths)
+        '''
+        if self._tree_built:
+            return
+        with self._lock:
+            self._build_indexes()
+            if not hasattr(self, 'children') or not hasattr(self, 'depths'):
+                parents = parent_ids(self.nodeindex)
+            if not hasattr(self, 'children'):
+                self.children = build_children(self.nodeindex, parents)
+            if not hasattr(self, 'depths'):
+                self.depths = compute_depths(
+                    self.nodeindex, self.children, parents
+                )
+            self._tree_built = True
+
+    def _build_digests(self):
+        '''
+        Build the per id line digests used by diff_dmpfiles from the dmp
+        files when they are paths or from the indexes otherwise
+        '''
+        if hasattr(self, 'digests'):
+            return
+        with self._lock:
+            self._build_indexes()
+            digests = {}
+            for dmptype, fh, index in (
+                    ('Name', self.namefh, self.nameindex),
+                    ('Node', self.nodefh, self.nodeindex),
+                    ('Division', self.divfh, self.divindex)):
+                if isinstance(fh, str) and os.path.isfile(fh):
+                    digests[dmptype] = dmp_digests(fh)
+                else:
+                    digests[dmptype] = index_digests(index)
+            self.digests = digests
+
+    def _build_jumps(self):
+        '''
+        Build the binary lifting table. jumps[k][i] is the position of the
+        2**k-th ancestor of the node at position i(roots are their own
+        ancestor). Positions index into taxids and levels.
+        '''
+        if self._jumps_built:
+            return
+        with self._lock:
+            self._build_tree()
+            if not hasattr(self, 'jumps'):
+                taxids = list(self.depths)
+                positions = dict((taxid, i) for i, taxid in enumerate(taxids))
+                levels = array('l', (self.depths[taxid] for taxid in taxids))
+                # Parents come from the child map so no Node has to be
+                # looked up. Roots stay their own parent.
+                parents = array('l', range(len(taxids)))
+                for parent_id, childids in self.children.items():
+                    parentpos = positions.get(parent_id)
+                    if parentpos is None:
+                        continue
+                    for childid in childids:
+                        childpos = positions.get(childid)
+                        if childpos is not None:
+                            parents[childpos] = parentpos
+                jumps = [parents]
+                for k in range(1, max(levels or [0]).bit_length()):
+                    prev = jumps[-1]
+                    jumps.append(array('l', [prev[i] for i in prev]))
+                self.taxids = taxids
+                self.positions = positions
+                self.levels = levels
+                self.jumps = jumps
+            self._jumps_built = True
+
+    def _position(self, taxid):
+        self._build_jumps()
+        try:
+            return self.positions[taxid]
+        except KeyError as e:
+            raise KeyError('taxid {0} is not connected to a root'.format(taxid))
+
+    def _lift(self, pos, k):
+        '''
+        Return the position of the k-th ancestor of the node at pos
+        '''
+        level = 0
+        while k:
+            if k & 1:
+                pos = self.jumps[level][pos]
+            k >>= 1
+            level += 1
+        return pos
+
+    def _lca(self, a, b):
+        '''
+        Return the position of the lowest common ancestor of the nodes at
+        positions a and b or None if they are in different trees
+        '''
+        levels = self.levels
+        if levels[a] < levels[b]:
+            a, b = b, a
+        a = self._lift(a, levels[a] - levels[b])
+        if a == b:
+            return a
+        for jump in reversed(self.jumps):
+            if jump[a] != jump[b]:
+                a = jump[a]
+                b = jump[b]
+        a = self.jumps[0][a]
+        b = self.jumps[0][b]
+        if a != b:
+            return None
+        return a
+
+    def _distance(self, a, b):
+        lca = self._lca(a, b)
+        if lca is None:
+            raise ValueError('taxids {0} and {1} are in different trees'.format(
+                self.taxids[a], self.taxids[b]
+            ))
+        return self.levels[a] + self.levels[b] - 2 * self.levels[lca]
+
+    def depth(self, taxid):
+        '''
+        Return the number of edges between taxid and the root
+        '''
+        pos = self._position(taxid)
+        return self.levels[pos]
+
+    def ancestor(self, taxid, k):
+        '''
+        Return the taxid k levels above taxid. ancestor(taxid, 0) is taxid
+
+        :param str taxid: taxid to start at
+        :param int k: number of levels to go up
+        '''
+        pos = self._position(taxid)
+        if k < 0 or k > self.levels[pos]:
+            raise ValueError('taxid {0} has no ancestor {1} levels up'.format(
+                taxid, k
+            ))
+        return self.taxids[self._lift(pos, k)]
+
+    def lca(self, a, b):
+        '''
+        Return the taxid of the lowest common ancestor of taxids a and b
+        '''
+        lca = self._lca(self._position(a), self._position(b))
+        if lca is None:
+            raise ValueError('taxids {0} and {1} are in different trees'.format(
+                a, b
+            ))
+        return self.taxids[lca]
+
+    def distance(self, a, b):
+        '''
+        Return the number of edges on the path between taxids a and b
+        '''
+        return self._distance(self._position(a), self._position(b))
+
+    def distance_matrix(self, taxids):
+        '''
+        Return the pairwise distances between taxids as a list of rows where
+        matrix[i][j] is distance(taxids[i], taxids[j])
+
+        :param list taxids: taxids to compare
+        '''
+        positions = [self._position(taxid) for taxid in taxids]
+        matrix = [[0] * len(positions) for pos in positions]
+        for i, a in enumerate(positions):
+            row = matrix[i]
+            for j in range(i + 1, len(positions)):
+                row[j] = matrix[j][i] = self._distance(a, positions[j])
+        return matrix
+
+    def validate(self):
+        '''
+        Check the indexes for problems. See validate_indexes
+        '''
+        self._build_indexes()
+        return validate_indexes(self.nameindex, self.nodeindex, self.divindex)
+
+    def lookup_many(self, taxids, threads=None):
+        '''
+        Look up many taxids concurrently. See lookup_many
+        '''
+        self._build_indexes()
+        return lookup_many(self, taxids, threads)
+
+    def __getitem__(self, key):
+        self._build_indexes()
+        try:
+            return Phylo(key, self.nameindex, self.nodeindex, self.divindex)
+        except ValueError as e:
+            raise KeyError(str(e))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def to_arrays(self):
+        '''
+        Return the taxonomy as a dictionary of NumPy arrays ordered by taxid
+
+            taxid, parent: int64 taxid and parent taxid
+            rank: int16 index into rank_labels
+            division: int16 division id
+            depth: int32 edges to the root, -1 if the root cannot be reached
+            name_offsets: int64 start of each scientific name in name_heap
+                with a final entry for the end of the heap
+            name_heap: uint8 utf-8 encoded scientific names
+            division_ids, division_codes, division_names: division.dmp
+
+        The arrays only depend on NumPy so other tools can load them as they
+        are. See from_arrays for the way back.
+        '''
+        _require_numpy()
+        self._build_tree()
+        taxids = sorted(self.nodeindex, key=int)
+        rank_labels = sorted(set(
+            self.nodeindex[taxid][0].rank for taxid in taxids
+        ))
+        rankcodes = dict((rank, i) for i, rank in enumerate(rank_labels))
+        parent = numpy.empty(len(taxids), dtype=numpy.int64)
+        rank = numpy.empty(len(taxids), dtype=numpy.int16)
+        division = numpy.empty(len(taxids), dtype=numpy.int16)
+        depth = numpy.empty(len(taxids), dtype=numpy.int32)
+        names = []
+        for i, taxid in enumerate(taxids):
+            node = self.nodeindex[taxid][0]
+            parent[i] = int(node.parent_id)
+            rank[i] = rankcodes[node.rank]
+            division[i] = int(node.division)
+            depth[i] = self.depths.get(taxid, -1)
+            names.append(_scientific_name(
+                self.nameindex.get(taxid, ())
+            ).encode('utf-8'))
+        name_offsets = numpy.zeros(len(names) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(name) for name in names], out=name_offsets[1:])
+        divisions = sorted(self.divindex, key=int)
+        return {
+            'taxid': numpy.array([int(t) for t in taxids], dtype=numpy.int64),
+            'parent': parent,
+            'rank': rank,
+            'rank_labels': numpy.array(rank_labels, dtype=numpy.str_),
+            'division': division,
+            'depth': depth,
+            'name_offsets': name_offsets,
+            'name_heap': numpy.frombuffer(b''.join(names), dtype=numpy.uint8),
+            'division_ids': numpy.array(
+                [int(d) for d in divisions], dtype=numpy.int16
+            ),
+            'division_codes': numpy.array(
+                [self.divindex[d][0].code for d in divisions], dtype=numpy.str_
+            ),
+            'division_names': numpy.array(
+                [self.divindex[d][0].name for d in divisions], dtype=numpy.str_
+            ),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''
+        Build a Phylogony from the arrays returned by to_arrays(or loaded
+        from save_npz). The arrays are used as they are without copying and
+        DmpLine objects are only created for the taxids that are looked up.
+        Only the columns present in the arrays are filled in and each taxid
+        only has its scientific name. The child map and depths come straight
+        from the parent and depth arrays.
+
+        :param dict arrays: mapping of array name to array
+        '''
+        _require_numpy()
+        arrays = dict(arrays)
+        inst = cls(None, None, None)
+        inst.nodeindex = _ArrayNodeIndex(arrays)
+        inst.nameindex = _ArrayNameIndex(arrays)
+        taxids = [str(taxid) for taxid in arrays['taxid'].tolist()]
+        inst.children = collections.defaultdict(list)
+        for taxid, parent in zip(taxids, arrays['parent'].tolist()):
+            parent = str(parent)
+            if parent != taxid:
+                inst.children[parent].append(taxid)
+        inst.depths = dict(
+            (taxid, depth)
+            for taxid, depth in zip(taxids, arrays['depth'].tolist())
+            if depth >= 0
+        )
+        inst.divindex = collections.defaultdict(list)
+        for divid, code, name in zip(
+                arrays['division_ids'], arrays['division_codes'],
+                arrays['division_names']):
+            inst.divindex[str(divid)].append(
+                Division([str(divid), str(code), str(name), ''])
+            )
+        return inst
+
+    def save_npz(self, path):
+        '''
+        Write the arrays from to_arrays to an uncompressed .npz file
+        '''
+        _require_numpy()
+        numpy.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load_npz(cls, path):
+        '''
+        Read a Phylogony written by save_npz
+        '''
+        _require_numpy()
+        with numpy.load(path) as npz:
+            arrays = dict((key, npz[key]) for key in npz.files)
+        return cls.from_arrays(arrays)
+
+    def save(self, path):
+        '''
+        Write the indexes and derived tree data to a compiled index file
+        that can be read back with Phylogony.load
+
+        The indexes are saved as CompactDmpIndex columns so the file holds
+        all of the data even for indexes that read the dmp files on demand
+        (mmap or sidecar).
+
+        :param str path: path to write compiled index to
+        '''
+        self._build_tree()
+        self._build_digests()
+        compiled = {
+            'version': self.index_version,
+            'nameindex': to_compact_index(self.nameindex, 'Name'),
+            'nodeindex': to_compact_index(self.nodeindex, 'Node'),
+            'divindex': to_compact_index(self.divindex, 'Division'),
+            'children': self.children,
+            'depths': self.depths,
+            'digests': self.digests,
+        }
+        # Written next to path and renamed into place so an interrupted
+        # save never leaves a truncated index behind
+        tmppath = path + '.tmp'
+        with open(tmppath, 'wb') as fh:
+            pickle.dump(compiled, fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a compiled index written by Phylogony.save
+
+        :param str path: path to compiled index
+        '''
+        with open(path, 'rb') as fh:
+            compiled = pickle.load(fh)
+        if compiled.get('version') != cls.index_version:
+            raise ValueError('{0} is not a version {1} compiled index'.format(
+                path, cls.index_version
+            ))
+        inst = cls(None, None, None)
+        for attr in (
+                'nameindex', 'nodeindex', 'divindex', 'children', 'depths',
+                'digests'):
+            setattr(inst, attr, compiled[attr])
+        return inst
+
+class ValidationReport(object):
+    '''
+    Problems found in a set of indexes by validate_indexes. Each attribute
+    is a list of taxids except for cycles which is a list of the taxids
+    making up each cycle.
+    '''
+    problems = (
+        'orphans', 'cycles', 'bad_roots', 'unreachable',
+        'unknown_divisions', 'unnamed'
+    )
+
+    def __init__(self):
+        for problem in self.problems:
+            setattr(self, problem, [])
+        self.details = {}
+
+    def __len__(self):
+        return sum(len(getattr(self, problem)) for problem in self.problems)
+
+    def report(self):
+        '''
+        Return the list of problems as tab separated lines of problem, taxid
+        and a description of the problem
+        '''
+        lines = []
+        for problem in self.problems:
+            for item in getattr(self, problem):
+                if problem == 'cycles':
+                    taxid = item[0]
+                    detail = ' -> '.join(item + [item[0]])
+                else:
+                    taxid = item
+                    detail = self.details.get((problem, taxid), '')
+                lines.append('{0}\t{1}\t{2}\n'.format(problem, taxid, detail))
+        return lines
+
+# States used by validate_indexes
+_REACHABLE, _UNREACHABLE = 1, 2
+
+def validate_indexes(nameindex, nodeindex, divindex):
+    '''
+    Check that every node can be walked up to the root named 'all' without
+    running into a missing parent, a cycle or a different root and that
+    every node has a name and a known division.
+
+    Every node is visited once by walking up from each node until a node
+    with a known result is found so this runs in linear time.
+
+    :param dict nameindex: index of Name objects
+    :param dict nodeindex: index of Node objects
+    :param dict divindex: index of Division objects
+    '''
+    report = ValidationReport()
+    # Plain dictionaries so the walk never builds Node objects when the
+    # index keeps its columns as arrays(see _node_columns)
+    parents = {}
+    for taxid, parent_id, divid in _node_columns(nodeindex):
+        parents[taxid] = parent_id
+        if taxid not in nameindex:
+            report.unnamed.append(taxid)
+        if divid not in divindex:
+            report.unknown_divisions.append(taxid)
+            report.details[('unknown_divisions', taxid)] = \
+                'division {0} missing'.format(divid)
+    state = {}
+    for taxid in parents:
+        if taxid in state:
+            continue
+        path = []
+        onpath = {}
+        curid = taxid
+        while True:
+            if curid in state:
+                result = state[curid]
+                break
+            onpath[curid] = len(path)
+            path.append(curid)
+            parent_id = parents[curid]
+            if parent_id == curid:
+                # Only the root needs its name looked up
+                curnames = nameindex.get(curid)
+                if curnames and curnames[0].name == 'all':
+                    result = _REACHABLE
+                else:
+                    report.bad_roots.append(curid)
+                    report.details[('bad_roots', curid)] = \
+                        'root is not named all'
+                    result = _UNREACHABLE
+                break
+            if parent_id not in parents:
+                report.orphans.append(curid)
+                report.details[('orphans', curid)] = \
+                    'parent {0} missing'.format(parent_id)
+                result = _UNREACHABLE
+                break
+            if parent_id in onpath:
+                report.cycles.append(path[onpath[parent_id]:])
+                result = _UNREACHABLE
+                break
+            curid = parent_id
+        for pathid in path:
+            state[pathid] = result
+    report.unreachable = [
+        taxid for taxid in parents if state[taxid] == _UNREACHABLE
+    ]
+    for problem in report.problems:
+        if problem != 'cycles':
+            getattr(report, problem).sort(key=_taxid_sort_key)
+    return report
+
+def ancestor_closure(phylogony, taxids):
+    '''
+    Return the set of taxids made up of every taxid given and all of their
+    ancestors up to and including the root
+
+    :param Phylogony phylogony: taxonomy to walk
+    :param iterable taxids: taxids to start from
+    '''
+    phylogony._build_indexes()
+    nodeindex = phylogony.nodeindex
+    closure = set()
+    for taxid in taxids:
+        while taxid not in closure:
+            nodes = nodeindex.get(taxid)
+            if not nodes:
+                raise KeyError('taxid {0} is missing from nodeindex'.format(
+                    taxid
+                ))
+            closure.add(taxid)
+            taxid = nodes[0].parent_id
+    return closure
+
+def write_pruned_taxonomy(phylogony, taxids, outdir, indexname='taxonomy.idx'):
+    '''
+    Write names.dmp, nodes.dmp and division.dmp to outdir containing only
+    the given taxids and their ancestors so that every one of the taxids
+    has the same phylogony as in phylogony. A compiled index is written
+    as well unless indexname is None.
+
+    Returns the set of taxids that were written
+
+    :param Phylogony phylogony: full taxonomy
+    :param iterable taxids: taxids that need to be kept
+    :param str outdir: existing directory to write to
+    :param str indexname: filename of the compiled index inside outdir
+    '''
+    closure = sorted(ancestor_closure(phylogony, taxids), key=_taxid_sort_key)
+    paths = [
+        os.path.join(outdir, filename)
+        for filename in ('names.dmp', 'nodes.dmp', 'division.dmp')
+    ]
+    divids = set()
+    with open(paths[0], 'w') as namefh, open(paths[1], 'w') as nodefh:
+        for taxid in closure:
+            for name in phylogony.nameindex.get(taxid, ()):
+                namefh.write(name.format())
+            for node in phylogony.nodeindex[taxid]:
+                nodefh.write(node.format())
+                divids.add(node.division)
+    with open(paths[2], 'w') as divfh:
+        for divid in sorted(divids, key=_taxid_sort_key):
+            for div in phylogony.divindex.get(divid, ()):
+                divfh.write(div.format())
+    if indexname is not None:
+        Phylogony(*paths).save(os.path.join(outdir, indexname))
+    return set(closure)
+
+def dmp_digests(path):
+    '''
+    Return a dictionary of id to a digest of the raw lines of that id in the
+    .dmp file at path. The lines are only split at the first tab, never
+    parsed.
+
+    :param str path: path to .dmp file(may be gzip compressed)
+    '''
+    raw = {}
+    md5 = hashlib.md5
+    runid = None
+    run = []
+    with _open_binary(path) as fh:
+        for line in fh:
+            taxid = line[:line.find(b'\t')]
+            if taxid != runid:
+                if run:
+                    data = b''.join(run)
+                    if runid in raw:
+                        # The lines of runid are not all next to each other
+                        data = raw[runid] + data
+                    raw[runid] = md5(data).digest()[:8]
+                runid = taxid
+                run = []
+            run.append(line)
+        if run:
+            data = b''.join(run)
+            if runid in raw:
+                data = raw[runid] + data
+            raw[runid] = md5(data).digest()[:8]
+    return dict(
+        (_native_str(taxid), digest) for taxid, digest in raw.items()
+        if taxid.strip()
+    )
+
+def _entries_digest(entries):
+    return hashlib.md5(b''.join(
+        entry.format().encode('utf-8') for entry in entries
+    )).digest()[:8]
+
+def index_digests(index):
+    '''
+    Return a dictionary of id to the digest dmp_digests would give the lines
+    of that id in index
+    '''
+    return dict((taxid, _entries_digest(index[taxid])) for taxid in index)
+
+class TaxonomyDiff(object):
+    '''
+    Set of changes between two taxonomy releases as computed by
+    diff_taxonomy. Each attribute is a sorted list of taxids.
+    '''
+    changes = ('added', 'removed', 'reparented', 'renamed', 'modified')
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        for change in self.changes:
+            setattr(self, change, [])
+        self.divisions_changed = False
+        self.details = {}
+        # Line digests of the new release if it was diffed from dmp files
+        self.digests = None
+
+    def __len__(self):
+        return sum(len(getattr(self, change)) for change in self.changes)
+
+    def _describe(self):
+        '''
+        Record a description of every change so the report stays correct
+        after old has been patched
+        '''
+        old, new = self.old, self.new
+        for change in ('added', 'modified'):
+            for taxid in getattr(self, change):
+                self.details[(change, taxid)] = _first_name(new.nameindex, taxid)
+        for taxid in self.removed:
+            self.details[('removed', taxid)] = _first_name(old.nameindex, taxid)
+        for taxid in self.reparented:
+            self.details[('reparented', taxid)] = '{0} -> {1}'.format(
+                old.nodeindex[taxid][0].parent_id,
+                new.nodeindex[taxid][0].parent_id
+            )
+        for taxid in self.renamed:
+            self.details[('renamed', taxid)] = '{0} -> {1}'.format(
+                _first_name(old.nameindex, taxid),
+                _first_name(new.nameindex, taxid)
+            )
+
+    def report(self):
+        '''
+        Return the list of changes as tab separated lines of
+        change, taxid and a description of the change
+        '''
+        lines = []
+        for change in self.changes:
+            for taxid in getattr(self, change):
+                lines.append('{0}\t{1}\t{2}\n'.format(
+                    change, taxid, self.details.get((change, taxid), '')
+                ))
+        if self.divisions_changed:
+            lines.append('divisions\t-\tdivision.dmp changed\n')
+        return lines
+
+def _first_name(nameindex, taxid):
+    names = nameindex.get(taxid)
+    if not names:
+        return ''
+    return names[0].name
+
+def _taxid_sort_key(taxid):
+    try:
+        return (0, int(taxid), taxid)
+    except ValueError:
+        return (1, 0, taxid)
+
+def _entry_values(entries):
+    return [entry.values() for entry in entries]
+
+def diff_taxonomy(old, new):
+    '''
+    Compute the nodes that were added, removed, reparented, renamed or
+    otherwise modified between two Phylogony instances
+
+    :param Phylogony old: previous release
+    :param Phylogony new: new release
+    '''
+    old._build_indexes()
+    new._build_indexes()
+    diff = TaxonomyDiff(old, new)
+    oldids = set(old.nodeindex)
+    newids = set(new.nodeindex)
+    diff.added = sorted(newids - oldids, key=_taxid_sort_key)
+    diff.removed = sorted(oldids - newids, key=_taxid_sort_key)
+    for taxid in sorted(oldids & newids, key=_taxid_sort_key):
+        oldnode = old.nodeindex[taxid][0]
+        newnode = new.nodeindex[taxid][0]
+        if oldnode.parent_id != newnode.parent_id:
+            diff.reparented.append(taxid)
+        elif oldnode.values() != newnode.values():
+            diff.modified.append(taxid)
+        oldnames = _entry_values(old.nameindex.get(taxid, ()))
+        newnames = _entry_values(new.nameindex.get(taxid, ()))
+        if oldnames != newnames:
+            diff.renamed.append(taxid)
+    olddivs = dict((k, _entry_values(v)) for k, v in old.divindex.items())
+    newdivs = dict((k, _entry_values(v)) for k, v in new.divindex.items())
+    diff.divisions_changed = olddivs != newdivs
+    diff._describe()
+    return diff
+
+def _index_taxids(path, dmptype, taxids):
+    '''
+    Return a dictionary index of only the lines of path whose id is in
+    taxids. Other lines are never parsed.
+    '''
+    klass = _dmpclass(dmptype)
+    wanted = set(taxid.encode('utf-8') for taxid in taxids)
+    index = collections.defaultdict(list)
+    if not wanted:
+        return index
+    with _open_binary(path) as fh:
+        for line in fh:
+            if line[:line.find(b'\t')] in wanted:
+                entry = klass(_native_str(line))
+                index[entry.id].append(entry)
+    return index
+
+def diff_dmpfiles(old, namefh, nodefh, divfh):
+    '''
+    Same as diff_taxonomy but compares old to a new set of dmp files without
+    indexing them. The raw lines of every id are digested and compared to
+    the digests kept in old so only the lines of ids whose digest changed
+    are parsed. diff.new only holds those ids.
+
+    :param Phylogony old: previous release(usually from Phylogony.load)
+    :param str namefh: path to new names.dmp
+    :param str nodefh: path to new nodes.dmp
+    :param str divfh: path to new division.dmp
+    '''
+    old._build_digests()
+    olddigests = old.digests
+    newdigests = {
+        'Name': dmp_digests(namefh),
+        'Node': dmp_digests(nodefh),
+        'Division': dmp_digests(divfh),
+    }
+    oldnodes, newnodes = olddigests['Node'], newdigests['Node']
+    oldnames, newnames = olddigests['Name'], newdigests['Name']
+    added = [taxid for taxid in newnodes if taxid not in oldnodes]
+    removed = [taxid for taxid in oldnodes if taxid not in newnodes]
+    changednodes = [
+        taxid for taxid, digest in newnodes.items()
+        if taxid in oldnodes and oldnodes[taxid] != digest
+    ]
+    changednames = [
+        taxid for taxid in set(oldnames) | set(newnames)
+        if oldnames.get(taxid) != newnames.get(taxid)
+        and taxid in oldnodes and taxid in newnodes
+    ]
+    new = Phylogony(None, None, None)
+    new.nodeindex = _index_taxids(nodefh, 'Node', added + changednodes)
+    new.nameindex = _index_taxids(namefh, 'Name', added + changednames)
+    if olddigests['Division'] != newdigests['Division']:
+        new.divindex = index_dmpfile(divfh, 'Division')
+    else:
+        new.divindex = old.divindex
+    diff = TaxonomyDiff(old, new)
+    diff.digests = newdigests
+    diff.added = sorted(added, key=_taxid_sort_key)
+    diff.removed = sorted(removed, key=_taxid_sort_key)
+    # Digests can differ for lines with the same values(for example \r\n
+    # line endings) so changes are confirmed on the parsed values
+    for taxid in sorted(changednodes, key=_taxid_sort_key):
+        oldnode = old.nodeindex[taxid][0]
+        newnode = new.nodeindex[taxid][0]
+        if oldnode.parent_id != newnode.parent_id:
+            diff.reparented.append(taxid)
+        elif oldnode.values() != newnode.values():
+            diff.modified.append(taxid)
+    for taxid in sorted(changednames, key=_taxid_sort_key):
+        oldvalues = _entry_values(old.nameindex.get(taxid, ()))
+        if oldvalues != _entry_values(new.nameindex.get(taxid, ())):
+            diff.renamed.append(taxid)
+    if new.divindex is not old.divindex:
+        olddivs = dict((k, _entry_values(v)) for k, v in old.divindex.items())
+        newdivs = dict((k, _entry_values(v)) for k, v in new.divindex.items())
+        diff.divisions_changed = olddivs != newdivs
+    diff._describe()
+    return diff
+
+def _mutable_index(index):
+    '''
+    Return index itself if it is a dictionary, otherwise a dictionary copy
+    of a read only index(compact, mmap or sidecar)
+    '''
+    if isinstance(index, dict):
+        return index
+    mutable = collections.defaultdict(list)
+    for taxid, entries in index.items():
+        mutable[taxid] = list(entries)
+    return mutable
+
+def _patch_index(index, changes):
+    '''
+    Return index with the entries of every id in changes replaced by
+    changes[id](an empty list removes the id). CompactDmpIndex instances
+    are patched column wise, other read only indexes are copied into a
+    dictionary first.
+    '''
+    if isinstance(index, CompactDmpIndex):
+        return index.patched(changes)
+    index = _mutable_index(index)
+    for taxid, entries in changes.items():
+        if entries:
+            index[taxid] = entries
+        else:
+            index.pop(taxid, None)
+    return index
+
+def apply_diff(phylogony, diff):
+    '''
+    Patch phylogony in place with the changes in diff. Only the subtrees
+    below added or reparented nodes have their depths recomputed and only
+    the changed lines are encoded into the indexes.
+
+    :param Phylogony phylogony: compiled phylogony to patch(usually diff.old)
+    :param TaxonomyDiff diff: changes from diff_taxonomy or diff_dmpfiles
+    '''
+    phylogony._build_tree()
+    phylogony._build_digests()
+    new = diff.new
+    children = phylogony.children
+    for taxid in diff.removed + diff.reparented:
+        parent_id = phylogony.nodeindex[taxid][0].parent_id
+        if taxid in children.get(parent_id, ()):
+            children[parent_id].remove(taxid)
+    for taxid in diff.removed:
+        phylogony.depths.pop(taxid, None)
+    nodechanges = dict((taxid, []) for taxid in diff.removed)
+    for taxid in diff.added + diff.reparented + diff.modified:
+        nodechanges[taxid] = new.nodeindex[taxid]
+    namechanges = dict((taxid, []) for taxid in diff.removed)
+    for taxid in diff.added + diff.renamed:
+        namechanges[taxid] = new.nameindex.get(taxid, [])
+    phylogony.nodeindex = _patch_index(phylogony.nodeindex, nodechanges)
+    phylogony.nameindex = _patch_index(phylogony.nameindex, namechanges)
+    for taxid in diff.added + diff.reparented:
+        parent_id = phylogony.nodeindex[taxid][0].parent_id
+        if parent_id != taxid:
+            children[parent_id].append(taxid)
+    for taxid in diff.removed:
+        children.pop(taxid, None)
+    if diff.divisions_changed:
+        phylogony.divindex = new.divindex
+    if diff.digests is not None:
+        phylogony.digests = diff.digests
+    else:
+        for dmptype, changes in (('Node', nodechanges), ('Name', namechanges)):
+            digests = phylogony.digests[dmptype]
+            for taxid, entries in changes.items():
+                if entries:
+                    digests[taxid] = _entries_digest(entries)
+                else:
+                    digests.pop(taxid, None)
+        if diff.divisions_changed:
+            phylogony.digests['Division'] = index_digests(phylogony.divindex)
+    update_depths(
+        phylogony.nodeindex, children, diff.added + diff.reparented,
+        phylogony.depths
+    )
+    # The jump table is rebuilt from the updated depths when next needed
+    for attr in ('taxids', 'positions', 'levels', 'jumps'):
+        if hasattr(phylogony, attr):
+            delattr(phylogony, attr)
+    phylogony._jumps_built = False
+    return phylogony
+
+def refresh_index(indexpath, namefh, nodefh, divfh):
+    '''
+    Update the compiled index at indexpath in place from a new set of dmp
+    files and return the TaxonomyDiff that was applied. See diff_dmpfiles.
+
+    :param str indexpath: compiled index written by Phylogony.save
+    :param str namefh: new names.dmp
+    :param str nodefh: new nodes.dmp
+    :param str divfh: new division.dmp
+    '''
+    old = Phylogony.load(indexpath)
+    diff = diff_dmpfiles(old, namefh, nodefh, divfh)
+    if len(diff) or diff.divisions_changed or diff.digests != old.digests:
+        apply_diff(old, diff)
+        old.save(indexpath)
+    return diff
+
+def _sql_column(header):
+    return re.sub(r'\W', '', header)
+
+sqlite_tables = (
+    ('nodes', 'Node'),
+    ('names', 'Name'),
+    ('divisions', 'Division'),
+)
+
+sqlite_indexes = (
+    'CREATE INDEX IF NOT EXISTS nodes_parent_id ON nodes (parent_id)',
+    'CREATE INDEX IF NOT EXISTS names_id ON names (id)',
+    'CREATE INDEX IF NOT EXISTS names_name ON names (name)',
+)
+
+def _require_sqlite():
+    if sqlite3 is None:
+        raise ImportError('sqlite3 is required for the sqlite backend')
+
+def load_sqlite(dbpath, namefh, nodefh, divfh, batchsize=50000):
+    '''
+    Bulk load the dmp files into a sqlite database at dbpath. Any existing
+    taxonomy tables in dbpath are replaced.
+
+    Rows are inserted in batches of batchsize inside a single transaction
+    and indexes are only created once all rows are loaded.
+
+    :param str dbpath: path to sqlite database
+    :param str namefh: File handle or filepath to names.dmp
+    :param str nodefh: File handle or filepath to nodes.dmp
+    :param str divfh: File handle or filepath to division.dmp
+    :param int batchsize: number of rows per executemany call
+    '''
+    _require_sqlite()
+    handles = {'Name': namefh, 'Node': nodefh, 'Division': divfh}
+    conn = sqlite3.connect(dbpath)
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA journal_mode = MEMORY')
+        with conn:
+            for table, dmptype in sqlite_tables:
+                headers = classmap[dmptype].headers
+                columns = []
+                for hdr in headers:
+                    coltype = 'TEXT'
+                    if hdr in classmap[dmptype].int_headers:
+                        coltype = 'INTEGER'
+                    if hdr == 'id' and table != 'names':
+                        coltype += ' PRIMARY KEY'
+                    columns.append('{0} {1}'.format(_sql_column(hdr), coltype))
+                conn.execute('DROP TABLE IF EXISTS {0}'.format(table))
+                conn.execute('CREATE TABLE {0} ({1})'.format(
+                    table, ', '.join(columns)
+                ))
+                insert = 'INSERT INTO {0} VALUES ({1})'.format(
+                    table, ', '.join('?' * len(headers))
+                )
+                batch = []
+                for entry in iter_dmpfile(handles[dmptype], dmptype):
+                    batch.append(entry.values())
+                    if len(batch) >= batchsize:
+                        conn.executemany(insert, batch)
+                        batch = []
+                conn.executemany(insert, batch)
+            for statement in sqlite_indexes:
+                conn.execute(statement)
+    finally:
+        conn.close()
+
+def _sql_row_values(row):
+    return [_text('') if value is None else _text(value) for value in row]
+
+class SqlitePhylogony(object):
+    '''
+    Phylogony backed by a sqlite database written by load_sqlite.
+
+    Each thread that queries the instance gets its own connection so lookups
+    may be done concurrently.
+    '''
+    # Stop walking up the tree after this many nodes in case of cycles
+    max_depth = 1000
+
+    _lineage_cte = '''
+        WITH RECURSIVE lineage(id, parent_id, depth) AS (
+            SELECT id, parent_id, 0 FROM nodes WHERE id = ?
+            UNION ALL
+            SELECT nodes.id, nodes.parent_id, lineage.depth + 1
+            FROM nodes JOIN lineage ON nodes.id = lineage.parent_id
+            WHERE lineage.id != lineage.parent_id AND lineage.depth < ?
+        )
+    '''
+
+    _nodes_sql = _lineage_cte + '''
+        SELECT nodes.* FROM lineage JOIN nodes ON nodes.id = lineage.id
+        ORDER BY lineage.depth
+    '''
+
+    _names_sql = _lineage_cte + '''
+        SELECT names.* FROM names WHERE names.id IN (SELECT id FROM lineage)
+        ORDER BY names.rowid
+    '''
+
+    _lineage_sql = _lineage_cte + '''
+        SELECT lineage.id, names.name, nodes.rank FROM lineage
+        JOIN nodes ON nodes.id = lineage.id
+        LEFT JOIN names ON names.id = lineage.id
+            AND names.name_class = 'scientific name'
+        GROUP BY lineage.depth
+        ORDER BY lineage.depth
+    '''
+
+    def __init__(self, dbpath):
+        _require_sqlite()
+        self.dbpath = dbpath
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.divindex = collections.defaultdict(list)
+        for row in self._connection().execute('SELECT * FROM divisions'):
+            entry = Division(_sql_row_values(row))
+            self.divindex[entry.id].append(entry)
+
+    def _connection(self):
+        '''
+        Return the connection for the calling thread, opening it if needed
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Only used by this thread but may be closed from another
+            conn = sqlite3.connect(self.dbpath, check_same_thread=False)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        '''
+        Close the connections of all threads. This should only be called
+        once all lookups have finished.
+        '''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def __getitem__(self, key):
+        conn = self._connection()
+        nodeindex = collections.defaultdict(list)
+        nameindex = collections.defaultdict(list)
+        params = (key, self.max_depth)
+        for row in conn.execute(self._nodes_sql, params):
+            entry = Node(_sql_row_values(row))
+            nodeindex[entry.id].append(entry)
+        for row in conn.execute(self._names_sql, params):
+            entry = Name(_sql_row_values(row))
+            nameindex[entry.id].append(entry)
+        try:
+            return Phylo(key, nameindex, nodeindex, self.divindex)
+        except ValueError as e:
+            raise KeyError(str(e))
+
+    def lineage(self, taxid):
+        '''
+        Return a list of (taxid, scientific name, rank) tuples starting at
+        taxid and ending at the root of the tree
+
+        :param str taxid: taxid to get lineage for
+        '''
+        rows = self._connection().execute(
+            self._lineage_sql, (taxid, self.max_depth)
+        ).fetchall()
+        if not rows:
+            raise KeyError('taxid {0} is missing from nodes'.format(taxid))
+        return [tuple(_sql_row_values(row)) for row in rows]
+
+    def lookup_many(self, taxids, threads=None):
+        '''
+        Look up many taxids concurrently. See lookup_many
+        '''
+        return lookup_many(self, taxids, threads)
+
+class LineageFormatter(object):
+    '''
+    Formats the phylogony of taxids as bytes and caches the result of every
+    taxid so repeated taxids are only formatted once.
+
+    Formats:
+        text: name(rank) -> name(rank) -> ... same as str(Phylo)
+        tsv: taxid, name and rank followed by the lineage names from the
+            root down joined by ;
+        ndjson: JSON object with taxid, name, rank and a lineage list of
+            taxid, name and rank objects starting at taxid
+        ranked: rank:name pairs from the root down joined by ; skipping
+            nodes without a rank
+        krona: tab separated lineage names from the root down as used by
+            Krona's text import
+
+    Unknown taxids format as empty bytes.
+
+    :param Phylogony phylogony: taxonomy to look taxids up in
+    :param str fmt: one of formats
+    '''
+    formats = ('text', 'tsv', 'ndjson', 'ranked', 'krona')
+
+    def __init__(self, phylogony, fmt='text'):
+        if fmt not in self.formats:
+            raise ValueError('{0} is not a valid format'.format(fmt))
+        self.phylogony = phylogony
+        self.fmt = fmt
+        self._encode = getattr(self, '_format_' + fmt)
+        self._cache = {}
+
+    def format(self, taxid):
+        '''
+        Return the formatted phylogony of taxid as utf-8 encoded bytes
+        '''
+        try:
+            return self._cache[taxid]
+        except KeyError as e:
+            pass
+        try:
+            phylo = self.phylogony[taxid]
+        except KeyError as e:
+            encoded = b''
+        else:
+            encoded = self._encode(phylo).encode('utf-8')
+        self._cache[taxid] = encoded
+        return encoded
+
+    def _lineage(self, phylo):
+        return [
+            (node.id, _scientific_name(names), node.rank)
+            for names, node, div in phylo.phylo
+        ]
+
+    def _format_text(self, phylo):
+        return str(phylo)
+
+    def _format_tsv(self, phylo):
+        lineage = self._lineage(phylo)
+        taxid, name, rank = lineage[0]
+        return '\t'.join((
+            taxid, name, rank,
+            ';'.join(name for taxid, name, rank in reversed(lineage))
+        ))
+
+    def _format_ndjson(self, phylo):
+        lineage = [
+            {'taxid': taxid, 'name': name, 'rank': rank}
+            for taxid, name, rank in self._lineage(phylo)
+        ]
+        record = dict(lineage[0])
+        record['lineage'] = lineage
+        return json.dumps(record, sort_keys=True)
+
+    def _format_ranked(self, phylo):
+        return ';'.join(
+            '{0}:{1}'.format(rank, name)
+            for taxid, name, rank in reversed(self._lineage(phylo))
+            if rank != 'no rank'
+        )
+
+    def _format_krona(self, phylo):
+        return '\t'.join(
+            name for taxid, name, rank in reversed(self._lineage(phylo))
+        )
+
+def fork_pool(processes=None, initializer=None, initargs=()):
+    '''
+    Return a multiprocessing Pool that uses fork where it is available so
+    workers share the parent's already built indexes instead of being sent
+    a pickled copy
+    '''
+    try:
+        context = multiprocessing.get_context('fork')
+    except (AttributeError, ValueError) as e:
+        context = multiprocessing
+    return context.Pool(processes, initializer, initargs)
+
+def _bounded_imap(pool, func, tasks, window):
+    '''
+    Yield func(task) for every task in order using pool while keeping at
+    most window tasks in flight
+    '''
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def ordered_imap(func, tasks, processes=None, initializer=None, initargs=()):
+    '''
+    Yield func(task) for every task in order using a pool of processes.
+    Unlike Pool.imap only a few tasks per process are in flight at a time
+    so tasks may be a lazily generated stream larger than memory.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    pool = fork_pool(processes, initializer, initargs)
+    try:
+        for result in _bounded_imap(pool, func, tasks, processes * 2):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+# LineageFormatter used by annotate worker processes.
+# Set by _init_annotate_worker
+_annotate_formatter = None
+
+def _init_annotate_worker(phylogony, fmt):
+    global _annotate_formatter
+    _annotate_formatter = LineageFormatter(phylogony, fmt)
+
+def is_gzip(path):
+    '''
+    Returns True if path starts with the gzip magic bytes
+    '''
+    with open(path, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
+
+def _open_binary(path):
+    if is_gzip(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def annotate_lines(formatter, data, taxid_column):
+    '''
+    Append the phylogony of the taxid in taxid_column as a new column to
+    every line in data. When the column holds several ; separated taxids
+    the first is used. Lines whose taxid is unknown get an empty column.
+
+    :param LineageFormatter formatter: formats the phylogony of a taxid
+    :param bytes data: complete lines of a tab separated BLAST report
+    :param int taxid_column: 1 based column holding the taxid
+    '''
+    out = []
+    for line in data.splitlines():
+        if not line:
+            continue
+        columns = line.split(b'\t')
+        lineage = b''
+        if len(columns) >= taxid_column:
+            taxid = columns[taxid_column - 1].split(b';', 1)[0].decode('utf-8')
+            lineage = formatter.format(taxid)
+        out.append(line + b'\t' + lineage + b'\n')
+    return b''.join(out)
+
+def _annotate_shard(args):
+    path, start, end, taxid_column = args
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    return annotate_lines(_annotate_formatter, data, taxid_column)
+
+def _annotate_chunk(args):
+    data, taxid_column = args
+    return annotate_lines(_annotate_formatter, data, taxid_column)
+
+def shard_file(path, chunksize):
+    '''
+    Split path into (start, end) byte ranges of about chunksize bytes that
+    always begin at the start of a line
+
+    :param str path: file to split
+    :param int chunksize: approximate size of each range
+    '''
+    size = os.path.getsize(path)
+    shards = []
+    start = 0
+    with open(path, 'rb') as fh:
+        while start < size:
+            fh.seek(min(start + chunksize, size))
+            fh.readline()
+            end = min(fh.tell(), size)
+            shards.append((start, end))
+            start = end
+    return shards
+
+def _gzip_chunks(path, chunksize, taxid_column):
+    with gzip.open(path, 'rb') as fh:
+        while True:
+            lines = fh.readlines(chunksize)
+            if not lines:
+                break
+            yield b''.join(lines), taxid_column
+
+def annotate_blast(phylogony, path, output, taxid_column, processes=None,
+                   chunksize=32 * 1024 * 1024, fmt='text'):
+    '''
+    Annotate every line of the BLAST tabular report at path with the
+    phylogony of its taxid and write the lines to output in their original
+    order.
+
+    Plain files are split into line aligned byte ranges that worker
+    processes read themselves. Gzip files are decompressed here and handed
+    to the workers in chunks of lines. The indexes are built before the
+    workers are started so that forked workers share them instead of each
+    parsing the dmp files.
+
+    :param Phylogony phylogony: taxonomy to look taxids up in
+    :param str path: BLAST tabular report, optionally gzip compressed
+    :param output: binary file handle to write to
+    :param int taxid_column: 1 based column holding the taxid
+    :param int processes: number of worker processes[Default: cpu count]
+    :param int chunksize: approximate number of bytes per shard
+    :param str fmt: LineageFormatter format of the new column
+    '''
+    phylogony._build_indexes()
+    if is_gzip(path):
+        worker = _annotate_chunk
+        tasks = _gzip_chunks(path, chunksize, taxid_column)
+    else:
+        worker = _annotate_shard
+        tasks = (
+            (path, start, end, taxid_column)
+            for start, end in shard_file(path, chunksize)
+        )
+    if processes == 1:
+        _init_annotate_worker(phylogony, fmt)
+        for task in tasks:
+            output.write(worker(task))
+        return
+    for annotated in ordered_imap(
+            worker, tasks, processes, _init_annotate_worker, (phylogony, fmt)):
+        output.write(annotated)
+
+def _spill_run(buffer, keyfunc, tmpdir):
+    buffer.sort(key=keyfunc)
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    run.writelines(buffer)
+    run.seek(0)
+    return run
+
+def _decorated_run(run, runindex, keyfunc):
+    # runindex and the line number keep lines with the same key in input
+    # order when the runs are merged
+    for lineno, line in enumerate(run):
+        yield keyfunc(line), runindex, lineno, line
+
+def _merge_decorated(runs, keyfunc):
+    return heapq.merge(
+        *[_decorated_run(run, i, keyfunc) for i, run in enumerate(runs)]
+    )
+
+# Most spilled runs group_lines merges together at once
+merge_width = 64
+
+def _merge_runs(runs, keyfunc, tmpdir):
+    '''
+    Merge consecutive sorted runs into a single run and close them
+    '''
+    try:
+        merged = tempfile.TemporaryFile(dir=tmpdir)
+        try:
+            merged.writelines(
+                line for key, runindex, lineno, line in
+                _merge_decorated(runs, keyfunc)
+            )
+        except:
+            merged.close()
+            raise
+    finally:
+        for run in runs:
+            run.close()
+    merged.seek(0)
+    return merged
+
+def _add_run(runs, levels, run, keyfunc, tmpdir):
+    # Runs are merged in tiers: once merge_width runs of the same level
+    # are at the end of runs they become one run of the next level. Only
+    # adjacent runs are merged so input order is kept for equal keys.
+    runs.append(run)
+    levels.append(0)
+    while len(runs) >= merge_width and levels[-merge_width] == levels[-1]:
+        batch = runs[-merge_width:]
+        level = levels[-1] + 1
+        del runs[-merge_width:]
+        del levels[-merge_width:]
+        runs.append(_merge_runs(batch, keyfunc, tmpdir))
+        levels.append(level)
+
+def group_lines(lines, keyfunc, max_memory=256 * 1024 * 1024, tmpdir=None):
+    '''
+    Group lines by keyfunc(line) even when lines with the same key are not
+    next to each other. Yields (key, list of lines) with lines kept in their
+    input order.
+
+    Lines are held in memory until they take up about max_memory bytes,
+    then sorted and spilled to a temporary file. Every merge_width spilled
+    runs are merged into a larger run so only a few files are open at a
+    time and inputs far larger than memory can be grouped.
+
+    :param iterable lines: newline terminated lines as bytes
+    :param callable keyfunc: returns the grouping key of a line
+    :param int max_memory: approximate bytes of lines to hold in memory
+    :param str tmpdir: directory for spilled runs[Default: system temp]
+    '''
+    runs = []
+    levels = []
+    buffer = []
+    used = 0
+    try:
+        for line in lines:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            buffer.append(line)
+            # Rough size of a bytes object plus its slot in the list
+            used += len(line) + 64
+            if used >= max_memory:
+                _add_run(
+                    runs, levels, _spill_run(buffer, keyfunc, tmpdir),
+                    keyfunc, tmpdir
+                )
+                buffer = []
+                used = 0
+        if not runs:
+            buffer.sort(key=keyfunc)
+            merged = ((keyfunc(line), line) for line in buffer)
+        else:
+            runs.append(_spill_run(buffer, keyfunc, tmpdir))
+            buffer = []
+            while len(runs) > merge_width:
+                batch = runs[:merge_width]
+                del runs[:merge_width]
+                runs.insert(0, _merge_runs(batch, keyfunc, tmpdir))
+            merged = (
+                (key, line) for key, runindex, lineno, line in
+                _merge_decorated(runs, keyfunc)
+            )
+        for key, group in itertools.groupby(merged, lambda item: item[0]):
+            yield key, [line for linekey, line in group]
+    finally:
+        for run in runs:
+            run.close()
+
+def _column(line, column):
+    return line.rstrip(b'\r\n').split(b'\t')[column - 1]
+
+def _hit_taxid(line, taxid_column):
+    return _column(line, taxid_column).split(b';', 1)[0].decode('utf-8')
+
+def resolve_hits(phylogony, hits, method='lca', taxid_column=13,
+                 score_column=12, consensus=0.5):
+    '''
+    Return the taxid that best describes the query of hits or None if none
+    of the hits have a known taxid
+
+    Methods:
+        best: taxid of the hit with the highest score
+        lca: lowest common ancestor of every hit's taxid
+        consensus: deepest taxid shared by at least consensus of the hits
+
+    :param Phylogony phylogony: taxonomy to resolve taxids in
+    :param list hits: tab separated BLAST hit lines for one query
+    :param str method: best, lca or consensus
+    :param int taxid_column: 1 based column holding the taxid
+    :param int score_column: 1 based column holding the score for best
+    :param float consensus: fraction of hits that have to agree
+    '''
+    taxids = []
+    for line in hits:
+        taxid = _hit_taxid(line, taxid_column)
+        try:
+            phylogony.depth(taxid)
+        except KeyError as e:
+            continue
+        taxids.append((taxid, line))
+    if not taxids:
+        return None
+    if method == 'best':
+        return max(
+            taxids, key=lambda hit: float(_column(hit[1], score_column))
+        )[0]
+    if method == 'lca':
+        lca = taxids[0][0]
+        for taxid, line in taxids[1:]:
+            try:
+                lca = phylogony.lca(lca, taxid)
+            except ValueError:
+                # Hits in different trees have no common ancestor
+                return None
+        return lca
+    if method == 'consensus':
+        counts = collections.Counter()
+        for taxid, line in taxids:
+            for k in range(phylogony.depth(taxid) + 1):
+                counts[phylogony.ancestor(taxid, k)] += 1
+        needed = consensus * len(taxids)
+        supported = [taxid for taxid, count in counts.items() if count >= needed]
+        if not supported:
+            return None
+        return max(supported, key=phylogony.depth)
+    raise ValueError('{0} is not a valid method'.format(method))
+
+def classify_queries(phylogony, lines, output, method='lca', query_column=1,
+                     taxid_column=13, score_column=12, consensus=0.5,
+                     max_memory=256 * 1024 * 1024, tmpdir=None, fmt='text',
+                     buffersize=1024 * 1024):
+    '''
+    Group BLAST hits by query with group_lines and write one line per query
+    to output holding the query, the taxid from resolve_hits and its
+    phylogony formatted with LineageFormatter. Queries that could not be
+    resolved get empty columns. Lines are written buffersize bytes at a time.
+
+    :param Phylogony phylogony: taxonomy to resolve taxids in
+    :param iterable lines: tab separated BLAST hit lines as bytes
+    :param output: binary file handle to write to
+    '''
+    formatter = LineageFormatter(phylogony, fmt)
+    def keyfunc(line):
+        return _column(line, query_column)
+    buffer = []
+    buffered = 0
+    for query, hits in group_lines(lines, keyfunc, max_memory, tmpdir):
+        taxid = resolve_hits(
+            phylogony, hits, method, taxid_column, score_column, consensus
+        )
+        if taxid is None:
+            line = query + b'\t\t\n'
+        else:
+            line = b''.join((
+                query, b'\t', taxid.encode('utf-8'), b'\t',
+                formatter.format(taxid), b'\n'
+            ))
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= buffersize:
+            output.write(b''.join(buffer))
+            buffer = []
+            buffered = 0
+    output.write(b''.join(buffer))
+
+def read_counts(path):
+    '''
+    Return a Counter of taxid to count from a tab separated file of taxid
+    and count lines(gzip compressed files are fine). A line with only a
+    taxid counts once.
+
+    :param str path: path to count file
+    '''
+    counts = collections.Counter()
+    with _open_binary(path) as fh:
+        for line in fh:
+            columns = line.split(b'\t')
+            taxid = columns[0].strip().decode('utf-8')
+            if not taxid:
+                continue
+            count = 1
+            if len(columns) > 1 and columns[1].strip():
+                count = int(columns[1])
+            counts[taxid] += count
+    return counts
+
+# taxid -> tuple of clade taxids its counts are added to(None if the taxid is
+# not in the taxonomy) used by abundance worker processes.
+# Set by _init_abundance_worker
+_abundance_clades = None
+
+def _init_abundance_worker(clades):
+    global _abundance_clades
+    _abundance_clades = clades
+
+def _sample_taxids(path):
+    return set(read_counts(path))
+
+def _resolve_clades(phylogony, ranks, taxid):
+    try:
+        phylo = phylogony[taxid]
+    except KeyError as e:
+        return None
+    return tuple(
+        node.id for names, node, div in phylo.phylo
+        if ranks is None or node.rank in ranks
+    )
+
+def _rollup_sample(path):
+    '''
+    Return a Counter of clade taxid to count for the sample at path and the
+    total count of taxids that are not in the taxonomy
+    '''
+    column = collections.Counter()
+    unknown = 0
+    for taxid, count in read_counts(path).items():
+        cladeids = _abundance_clades[taxid]
+        if cladeids is None:
+            unknown += count
+            continue
+        for cladeid in cladeids:
+            column[cladeid] += count
+    return column, unknown
+
+def build_abundance_matrix(phylogony, paths, prefix, ranks=None, processes=None):
+    '''
+    Roll the taxid counts of every sample up to each clade in its lineage and
+    write a sparse clade by sample matrix as
+
+        prefix.rows.tsv: row, taxid, rank and name of each clade
+        prefix.cols.tsv: col and name of each sample
+        prefix.triplets.tsv: row, col and count of every non zero entry
+
+    Samples are read twice by parallel worker processes. The first pass
+    collects the distinct taxids of all samples so that each one's lineage
+    is resolved only once, and the second rolls each sample up using the
+    resolved clades. Only one sample's counts are held at a time.
+
+    Returns a dictionary of summary counts
+
+    :param Phylogony phylogony: taxonomy to roll counts up in
+    :param list paths: per sample count files, see read_counts
+    :param str prefix: prefix of output files
+    :param iterable ranks: only make rows for clades of these ranks
+    :param int processes: number of processes rolling up samples
+    '''
+    phylogony._build_indexes()
+    ranks = set(ranks) if ranks else None
+    paths = list(paths)
+    if processes == 1:
+        sampletaxids = (_sample_taxids(path) for path in paths)
+    else:
+        sampletaxids = ordered_imap(_sample_taxids, paths, processes)
+    clades = {}
+    for taxids in sampletaxids:
+        for taxid in taxids:
+            if taxid not in clades:
+                clades[taxid] = _resolve_clades(phylogony, ranks, taxid)
+    if processes == 1:
+        _init_abundance_worker(clades)
+        samples = (_rollup_sample(path) for path in paths)
+    else:
+        samples = ordered_imap(
+            _rollup_sample, paths, processes, _init_abundance_worker, (clades,)
+        )
+    rowlabels = []
+    rows = {}
+    summary = {'samples': 0, 'rows': 0, 'entries': 0, 'unknown': 0}
+    with open(prefix + '.triplets.tsv', 'w') as triplets, \
+            open(prefix + '.cols.tsv', 'w') as cols:
+        for col, (path, (counts, unknown)) in enumerate(zip(paths, samples)):
+            cols.write('{0}\t{1}\n'.format(col, os.path.basename(path)))
+            summary['unknown'] += unknown
+            column = {}
+            for cladeid in sorted(counts, key=_taxid_sort_key):
+                if cladeid not in rows:
+                    rows[cladeid] = len(rowlabels)
+                    rowlabels.append((
+                        cladeid, phylogony.nodeindex[cladeid][0].rank,
+                        _scientific_name(phylogony.nameindex.get(cladeid, ()))
+                    ))
+                column[rows[cladeid]] = counts[cladeid]
+            for row in sorted(column):
+                triplets.write('{0}\t{1}\t{2}\n'.format(row, col, column[row]))
+            summary['samples'] += 1
+            summary['entries'] += len(column)
+    with open(prefix + '.rows.tsv', 'w') as fh:
+        for row, label in enumerate(rowlabels):
+            fh.write('{0}\t{1}\t{2}\t{3}\n'.format(row, *label))
+    summary['rows'] = len(rowlabels)
+    return summary
+
+# Ranks that get their own column in export_lineages
+lineage_ranks = (
+    'superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus',
+    'species',
+)
+
+def iter_lineages(phylogony):
+    '''
+    Yield (taxid, name, rank, ranked, lineage) for every node reachable from
+    a root in a single top down traversal. ranked is a tuple with the name
+    of the ancestor at each of lineage_ranks('' if there is none) and
+    lineage is the tuple of scientific names from below the root down to
+    the node. Each node's values are built from its parent's so no lineage
+    is walked more than once.
+
+    :param Phylogony phylogony: taxonomy to traverse
+    '''
+    phylogony._build_tree()
+    nodeindex = phylogony.nodeindex
+    nameindex = phylogony.nameindex
+    children = phylogony.children
+    rankpositions = dict((rank, i) for i, rank in enumerate(lineage_ranks))
+    roots = [taxid for taxid, depth in phylogony.depths.items() if depth == 0]
+    stack = [
+        (taxid, ('',) * len(lineage_ranks), ())
+        for taxid in sorted(roots, key=_taxid_sort_key, reverse=True)
+    ]
+    while stack:
+        taxid, ranked, lineage = stack.pop()
+        name = _scientific_name(nameindex.get(taxid, ()))
+        rank = nodeindex[taxid][0].rank
+        # The root itself(its own parent) is left out of every lineage
+        if nodeindex[taxid][0].parent_id != taxid:
+            lineage = lineage + (name,)
+            position = rankpositions.get(rank)
+            if position is not None:
+                ranked = ranked[:position] + (name,) + ranked[position + 1:]
+        yield taxid, name, rank, ranked, lineage
+        for childid in sorted(
+                children.get(taxid, ()), key=_taxid_sort_key, reverse=True):
+            stack.append((childid, ranked, lineage))
+
+def _encode_lineage_rows(args):
+    rows, compress = args
+    data = ''.join(
+        '\t'.join((taxid, name, rank) + ranked + (';'.join(lineage),)) + '\n'
+        for taxid, name, rank, ranked, lineage in rows
+    ).encode('utf-8')
+    if compress:
+        # Every chunk is a complete gzip member and concatenated members
+        # are a valid gzip file
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        data = compressor.compress(data) + compressor.flush()
+    return data
+
+def export_lineages(phylogony, output, compress=False, threads=None,
+                    chunkrows=50000):
+    '''
+    Write a tab separated table with one row per taxid holding its taxid,
+    name, rank, a column for each of lineage_ranks and the full lineage
+    joined by ;. The first line is a header starting with #.
+
+    Rows come from iter_lineages and are handed out in chunks of chunkrows
+    to a pool of threads that encode(and optionally gzip) them while the
+    traversal carries on. Chunks are written in traversal order.
+
+    :param Phylogony phylogony: taxonomy to export
+    :param output: binary file handle to write to
+    :param bool compress: gzip compress the output
+    :param int threads: number of encoding threads[Default: cpu count]
+    :param int chunkrows: rows per chunk
+    '''
+    def chunks():
+        yield [(
+            '#taxid', 'name', 'rank', lineage_ranks, ('lineage',)
+        )], compress
+        rows = iter_lineages(phylogony)
+        while True:
+            chunk = list(itertools.islice(rows, chunkrows))
+            if not chunk:
+                break
+            yield chunk, compress
+    threads = threads or multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    try:
+        for data in _bounded_imap(pool, _encode_lineage_rows, chunks(), threads * 2):
+            output.write(data)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    command = argv[0] if argv else None
+    if command in commands:
+        return commands[command](argv[1:])
+    args = parse_args(argv)
+    indexer = None
+    if args.mmap:
+        indexer = mmap_index_dmpfile
+    elif args.sidecar:
+        indexer = sidecar_index_dmpfile
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp, indexer)
+    sys.stdout.write(str(p[args.taxid]) + '\n')
+
+def _add_dmp_arguments(parser):
+    parser.add_argument(
+        'namedmp',
+        help='names.dmp file'
+    )
+
+    parser.add_argument(
+        'nodedmp',
+        help='nodes.dmp file'
+    )
+
+    parser.add_argument(
+        'divisiondmp',
+        help='division.dmp'
+    )
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+
+    _add_dmp_arguments(parser)
+
+    parser.add_argument(
+        'taxid',
+        help='taxid to lookup phylogony for'
+    )
+
+    parser.add_argument(
+        '--mmap',
+        action='store_true',
+        default=False,
+        help='Memory map the dmp files instead of reading them'
+    )
+
+    parser.add_argument(
+        '--sidecar',
+        action='store_true',
+        default=False,
+        help='Only read the lines needed for the lookup using byte offset '
+            'sidecar files next to each dmp file. They are created if needed'
+    )
+
+    return parser.parse_args(args)
+
+def compile_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax compile',
+        description='Compile dmp files into a single index file'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'index',
+        help='Path to write compiled index to'
+    )
+    parser.add_argument(
+        '--validate',
+        action='store_true',
+        default=False,
+        help='Refuse to write the index if blasttax validate finds problems'
+    )
+    args = parser.parse_args(argv)
+    p = Phylogony(
+        args.namedmp, args.nodedmp, args.divisiondmp, compact_index_dmpfile
+    )
+    if args.validate:
+        report = p.validate()
+        if len(report):
+            sys.stderr.writelines(report.report())
+            return 1
+    p.save(args.index)
+
+def refresh_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax refresh',
+        description='Patch a compiled index in place from newer dmp files'
+    )
+    parser.add_argument(
+        'index',
+        help='Compiled index from blasttax compile'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        '--report',
+        default=None,
+        help='Write change report here instead of stdout'
+    )
+    args = parser.parse_args(argv)
+    diff = refresh_index(
+        args.index, args.namedmp, args.nodedmp, args.divisiondmp
+    )
+    if args.report is None:
+        sys.stdout.writelines(diff.report())
+    else:
+        with open(args.report, 'w') as fh:
+            fh.writelines(diff.report())
+
+def sqlite_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax sqlite',
+        description='Load dmp files into a sqlite database'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'database',
+        help='Path to sqlite database to write'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=50000,
+        help='Number of rows to insert at a time[Default: %(default)s]'
+    )
+    args = parser.parse_args(argv)
+    load_sqlite(
+        args.database, args.namedmp, args.nodedmp, args.divisiondmp,
+        args.batch_size
+    )
+
+def prune_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax prune',
+        description='Write dmp files containing only the given taxids and '
+            'their ancestors'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'taxids',
+        help='File with one taxid per line'
+    )
+    parser.add_argument(
+        'outdir',
+        help='Directory to write the pruned dmp files to'
+    )
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        default=False,
+        help='Do not write a compiled index next to the pruned dmp files'
+    )
+    args = parser.parse_args(argv)
+    with open(args.taxids) as fh:
+        taxids = [line.strip() for line in fh if line.strip()]
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
+    indexname = None if args.no_index else 'taxonomy.idx'
+    write_pruned_taxonomy(p, taxids, args.outdir, indexname)
+
+def validate_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax validate',
+        description='Check dmp files for orphans, cycles, unreachable nodes, '
+            'unknown divisions and nodes without names. Exits with 1 if any '
+            'problems are found'
+    )
+    _add_dmp_arguments(parser)
+    args = parser.parse_args(argv)
+    p = Phylogony(
+        args.namedmp, args.nodedmp, args.divisiondmp, mmap_index_dmpfile
+    )
+    report = p.validate()
+    sys.stdout.writelines(report.report())
+    if len(report):
+        return 1
+    return 0
+
+def _add_format_argument(parser):
+    parser.add_argument(
+        '--format',
+        choices=LineageFormatter.formats,
+        default='text',
+        help='How to format the phylogony[Default: %(default)s]'
+    )
+
+def _binary_stdout():
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+def annotate_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax annotate',
+        description='Append the phylogony of each hit to a tabular BLAST '
+            'report using multiple processes'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'blastreport',
+        help='Tabular BLAST report(outfmt 6). May be gzip compressed'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='File to write annotated report to[Default: stdout]'
+    )
+    parser.add_argument(
+        '--taxid-column',
+        type=int,
+        default=13,
+        help='1 based column holding the taxid. The default matches '
+            '-outfmt "6 std staxids"[Default: %(default)s]'
+    )
+    parser.add_argument(
+        '-p', '--processes',
+        type=int,
+        default=None,
+        help='Number of processes to use[Default: cpu count]'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=32 * 1024 * 1024,
+        help='Approximate number of bytes each process handles at a time'
+            '[Default: %(default)s]'
+    )
+    _add_format_argument(parser)
+    args = parser.parse_args(argv)
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
+    if args.output is None:
+        annotate_blast(
+            p, args.blastreport, _binary_stdout(), args.taxid_column,
+            args.processes, args.chunk_size, args.format
+        )
+    else:
+        with open(args.output, 'wb') as fh:
+            annotate_blast(
+                p, args.blastreport, fh, args.taxid_column,
+                args.processes, args.chunk_size, args.format
+            )
+
+def parse_size(size):
+    '''
+    Convert a size such as 512M or 2G into a number of bytes
+    '''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def classify_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax classify',
+        description='Assign a single taxid to every query of a tabular BLAST '
+            'report whose hits do not have to be grouped by query'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'blastreport',
+        help='Tabular BLAST report(outfmt 6). May be gzip compressed'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='File to write classifications to[Default: stdout]'
+    )
+    parser.add_argument(
+        '--method',
+        choices=('lca', 'best', 'consensus'),
+        default='lca',
+        help='How to pick the taxid for a query[Default: %(default)s]'
+    )
+    parser.add_argument(
+        '--consensus',
+        type=float,
+        default=0.5,
+        help='Fraction of hits that must agree for --method consensus'
+            '[Default: %(default)s]'
+    )
+    parser.add_argument(
+        '--taxid-column',
+        type=int,
+        default=13,
+        help='1 based column holding the taxid[Default: %(default)s]'
+    )
+    parser.add_argument(
+        '--score-column',
+        type=int,
+        default=12,
+        help='1 based column holding the score used by --method best'
+            '[Default: %(default)s]'
+    )
+    parser.add_argument(
+        '--max-memory',
+        type=parse_size,
+        default='256M',
+        help='Memory to use for grouping hits before spilling to disk'
+            '[Default: %(default)s]'
+    )
+    parser.add_argument(
+        '--tmpdir',
+        default=None,
+        help='Directory to spill to[Default: system temp directory]'
+    )
+    _add_format_argument(parser)
+    args = parser.parse_args(argv)
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
+    output = _binary_stdout()
+    if args.output is not None:
+        output = open(args.output, 'wb')
+    try:
+        with _open_binary(args.blastreport) as fh:
+            classify_queries(
+                p, fh, output, args.method, 1, args.taxid_column,
+                args.score_column, args.consensus, args.max_memory, args.tmpdir,
+                args.format
+            )
+    finally:
+        if args.output is not None:
+            output.close()
+
+def abundance_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax abundance',
+        description='Build a sparse clade by sample count matrix from per '
+            'sample taxid count files'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'samples',
+        nargs='*',
+        help='Tab separated taxid and count files, one per sample'
+    )
+    parser.add_argument(
+        '--sample-list',
+        default=None,
+        help='File listing one sample count file per line'
+    )
+    parser.add_argument(
+        '-o', '--prefix',
+        required=True,
+        help='Prefix for the .rows.tsv, .cols.tsv and .triplets.tsv files'
+    )
+    parser.add_argument(
+        '--ranks',
+        default=None,
+        help='Comma separated ranks to make rows for[Default: all ranks]'
+    )
+    parser.add_argument(
+        '-p', '--processes',
+        type=int,
+        default=None,
+        help='Number of processes rolling up samples[Default: cpu count]'
+    )
+    args = parser.parse_args(argv)
+    samples = list(args.samples)
+    if args.sample_list is not None:
+        with open(args.sample_list) as fh:
+            samples.extend(line.strip() for line in fh if line.strip())
+    if not samples:
+        parser.error('no samples given')
+    ranks = None
+    if args.ranks is not None:
+        ranks = args.ranks.split(',')
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
+    build_abundance_matrix(p, samples, args.prefix, ranks, args.processes)
+
+def npz_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax npz',
+        description='Write the taxonomy as NumPy arrays to a .npz file'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        'npz',
+        help='Path to write .npz file to'
+    )
+    args = parser.parse_args(argv)
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
+    p.save_npz(args.npz)
+
+def lineages_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='blasttax lineages',
+        description='Write a table with the full ranked lineage of every taxid'
+    )
+    _add_dmp_arguments(parser)
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Path to write table to[Default: stdout]. Paths ending in .gz '
+            'are gzip compressed'
+    )
+    parser.add_argument(
+        '--gzip',
+        action='store_true',
+        default=False,
+        help='Gzip compress the output'
+    )
+    parser.add_argument(
+        '-t', '--threads',
+        type=int,
+        default=None,
+        help='Number of encoding threads[Default: cpu count]'
+    )
+    args = parser.parse_args(argv)
+    compress = args.gzip or (
+        args.output is not None and args.output.endswith('.gz')
+    )
+    p = Phylogony(args.namedmp, args.nodedmp, args.divisiondmp)
+    if args.output is None:
+        output = _binary_stdout()
+    else:
+        output = open(args.output, 'wb')
+    try:
+        export_lineages(p, output, compress, args.threads)
+    finally:
+        if args.output is not None:
+            output.close()
+
+commands = {
+    'compile': compile_main,
+    'refresh': refresh_main,
+    'sqlite': sqlite_main,
+    'prune': prune_main,
+    'validate': validate_main,
+    'annotate': annotate_main,
+    'classify': classify_main,
+    'abundance': abundance_main,
+    'npz': npz_main,
+    'lineages': lineages_main,
+}
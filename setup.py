@@ -20,6 +20,9 @@ setup(
         ]
     },
     install_requires = [],
+    extras_require = {
+        'numpy': ['numpy'],
+    },
     author = 'Tyghe Vallard',
     author_email = 'vallardt@gmail.com',
     description = 'Easily get taxonomy/phylogony information for a blast taxid',
@@ -1,5 +1,18 @@
 import unittest
 import re
+import os
+import pickle
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import random
+import gzip
+import io
+import collections
+import json
+import glob
 
 from mock import *
 
@@ -110,6 +123,11 @@ class TestName(unittest.TestCase):
         self.assertEqual(r.id, '2')
         self.assertEqual(r.name, 'Bacteria')
 
+    def test_strips_line_terminator(self):
+        r = blasttax.Name(self.dmpline + '\n')
+        self.assertEqual(r.name_class, 'scientific name')
+        self.assertEqual(r.unique_name, 'Bacteria <prokaryote>')
+
 class TestDivision(unittest.TestCase):
     def setUp(self):
         self.dmpline = div_dmp.splitlines()[0]
@@ -220,15 +238,68 @@ class TestPhylo(unittest.TestCase):
         ).__str__()
         self.assertEquals(e, r)
 
-    def test_only_builds_phylogony_once(self):
+    def test_stores_lineage_taxids(self):
+        r = blasttax.Phylo(
+            '2', self.nameindex, self.nodeindex, self.divindex
+        )
+        self.assertEqual(r.lineage, ('2', '3', '4', '5'))
+        self.assertEqual(r.taxid, '2')
+        self.assertEqual(
+            r.names, ('Bacteria', 'genusname', 'ordername', 'familyname')
+        )
+        self.assertFalse(hasattr(r, '__dict__'))
+
+    def test_builds_rank_dictionary_on_demand(self):
         r = blasttax.Phylo(
             '2', self.nameindex, self.nodeindex, self.divindex
         )
-        r.species
-        r.phylo = MagicMock()
-        r.phylo.append.side_effect = Exception('should not be called')
-        r.species
-        r._build_phylogony('2')
+        self.assertEqual(r._ranks, None)
+        self.assertEqual(
+            sorted(r.ranks), ['family', 'genus', 'order', 'species']
+        )
+        self.assertIs(r.ranks, r._ranks)
+
+    def test_hashes_and_compares_by_lineage(self):
+        a = blasttax.Phylo('2', self.nameindex, self.nodeindex, self.divindex)
+        b = blasttax.Phylo('2', self.nameindex, self.nodeindex, self.divindex)
+        c = blasttax.Phylo('3', self.nameindex, self.nodeindex, self.divindex)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertEqual(1, len(set([a, b])))
+
+    def test_pickles_only_its_lineage(self):
+        r = blasttax.Phylo('4', self.nameindex, self.nodeindex, self.divindex)
+        u = pickle.loads(pickle.dumps(r))
+        self.assertEqual(r, u)
+        self.assertEqual(str(r), str(u))
+        self.assertEqual(u.order, ['ordername'])
+        self.assertEqual(sorted(u.nodeindex), ['4', '5'])
+
+    def test_detects_cycles(self):
+        self.nodeindex['1'][0].parent_id = '2'
+        self.nameindex['1'] = self.nameindex['1'][1:]
+        self.assertRaises(
+            ValueError,
+            blasttax.Phylo,
+            '2', self.nameindex, self.nodeindex, self.divindex
+        )
+
+    def test_is_immutable(self):
+        r = blasttax.Phylo(
+            '2', self.nameindex, self.nodeindex, self.divindex
+        )
+        self.assertRaises(AttributeError, setattr, r, 'phylo', [])
+        self.assertRaises(AttributeError, setattr, r, 'genus', [])
+        self.assertRaises(AttributeError, delattr, r, 'taxid')
+
+    def test_missing_parent_does_not_modify_indexes(self):
+        del self.nameindex['3']
+        self.assertRaises(
+            ValueError,
+            blasttax.Phylo,
+            '2', self.nameindex, self.nodeindex, self.divindex
+        )
+        self.assertNotIn('3', self.nameindex)
 
 class TestPhylogony(unittest.TestCase):
     def setUp(self):
@@ -256,6 +327,23 @@ class TestPhylogony(unittest.TestCase):
     def test_no_taxid(self):
         self.assertRaises(KeyError, self.inst.__getitem__, '99')
 
+    def test_lookup_many(self):
+        r = self.inst.lookup_many(['2', '99', '6'], threads=3)
+        self.assertEqual(str(r[0]).split(' -> ')[0], 'Bacteria(species)')
+        self.assertEqual(r[1], None)
+        self.assertEqual(str(r[2]), 'Azorhizobium(species)')
+
+    def test_concurrent_lookups_build_indexes_once(self):
+        index_dmpfile = blasttax.index_dmpfile
+        def slow_index(*args):
+            # Give the other threads a chance to race on the indexes
+            time.sleep(0.02)
+            return index_dmpfile(*args)
+        with patch('blasttax.index_dmpfile', side_effect=slow_index) as mock:
+            r = blasttax.lookup_many(self.inst, ['2'] * 8, threads=8)
+            self.assertEqual(3, mock.call_count)
+        self.assertEqual(set(str(p) for p in r), set([str(r[0])]))
+
     def test_only_builds_index_once(self):
         self.inst.nameindex = blasttax.index_dmpfile(self.namefh, 'Name')
         self.inst.nodeindex = blasttax.index_dmpfile(self.nodefh, 'Node')
@@ -282,8 +370,1263 @@ class TestMain(unittest.TestCase):
                 mock_parse_args.return_value.namedmp = self.namefh
                 mock_parse_args.return_value.nodedmp = self.nodefh
                 mock_parse_args.return_value.divisiondmp = self.divfh
+                mock_parse_args.return_value.mmap = False
+                mock_parse_args.return_value.sidecar = False
                 r = blasttax.main()
                 msys.stdout.write.assert_called_with(
                     'Bacteria(species) -> genusname(genus) -> '\
                     'ordername(order) -> familyname(family)\n'
                 )
+
+# Taxid 6 lists a synonym before its scientific name like many real dumps
+synonym_first_names_dmp = names_dmp.replace(
+    '6\t|\tAzorhizobium\t|\t\t|\tscientific name\t|\n'
+    '6\t|\tAzorhizobium Dreyfus et al. 1988\t|\t\t|\tsynonym\t|\n',
+    '6\t|\tAzorhizobium Dreyfus et al. 1988\t|\t\t|\tsynonym\t|\n'
+    '6\t|\tAzorhizobium\t|\t\t|\tscientific name\t|\n'
+)
+
+def write_dmp_files(outdir, names=names_dmp, nodes=nodes_dmp, divs=div_dmp):
+    paths = []
+    for filename, contents in (
+            ('names.dmp', names), ('nodes.dmp', nodes), ('division.dmp', divs)):
+        path = os.path.join(outdir, filename)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        paths.append(path)
+    return paths
+
+class TempdirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dmps = write_dmp_files(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+class TestDepths(unittest.TestCase):
+    def setUp(self):
+        self.nodefh = MagicMock()
+        self.nodefh.__enter__.return_value = nodes_dmp.splitlines()
+        self.nodeindex = blasttax.index_dmpfile(self.nodefh, 'Node')
+
+    def test_builds_children(self):
+        r = blasttax.build_children(self.nodeindex)
+        self.assertEqual(sorted(r['1']), ['5', '6'])
+        self.assertEqual(r['3'], ['2'])
+        self.assertNotIn('2', r)
+
+    def test_computes_depths(self):
+        children = blasttax.build_children(self.nodeindex)
+        r = blasttax.compute_depths(self.nodeindex, children)
+        self.assertEqual(
+            r, {'1': 0, '5': 1, '6': 1, '4': 2, '3': 3, '2': 4}
+        )
+
+class TestCompiledIndex(TempdirTestCase):
+    def test_save_and_load_roundtrip(self):
+        indexpath = os.path.join(self.tempdir, 'taxonomy.idx')
+        blasttax.Phylogony(*self.dmps).save(indexpath)
+        p = blasttax.Phylogony.load(indexpath)
+        self.assertEqual(p.depths['2'], 4)
+        self.assertEqual(
+            str(p['2']),
+            'Bacteria(species) -> genusname(genus) -> '
+            'ordername(order) -> familyname(family)'
+        )
+
+    def test_load_rejects_other_versions(self):
+        indexpath = os.path.join(self.tempdir, 'taxonomy.idx')
+        with patch.object(blasttax.Phylogony, 'index_version', 0):
+            blasttax.Phylogony(*self.dmps).save(indexpath)
+        self.assertRaises(ValueError, blasttax.Phylogony.load, indexpath)
+
+    def test_saves_data_of_path_backed_indexes(self):
+        indexpaths = []
+        for indexer in (
+                blasttax.mmap_index_dmpfile, blasttax.sidecar_index_dmpfile):
+            indexpath = os.path.join(
+                self.tempdir, indexer.__name__ + '.idx'
+            )
+            blasttax.Phylogony(*self.dmps, indexer=indexer).save(indexpath)
+            indexpaths.append(indexpath)
+        for path in glob.glob(os.path.join(self.tempdir, '*.dmp*')):
+            os.remove(path)
+        for indexpath in indexpaths:
+            p = blasttax.Phylogony.load(indexpath)
+            self.assertTrue(isinstance(p.nodeindex, blasttax.CompactDmpIndex))
+            self.assertEqual(
+                str(p['2']),
+                'Bacteria(species) -> genusname(genus) -> '
+                'ordername(order) -> familyname(family)'
+            )
+
+    def test_interrupted_save_keeps_old_index(self):
+        indexpath = os.path.join(self.tempdir, 'taxonomy.idx')
+        p = blasttax.Phylogony(*self.dmps)
+        p.save(indexpath)
+        with patch('blasttax.pickle.dump', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, p.save, indexpath)
+        self.assertEqual(blasttax.Phylogony.load(indexpath).depths['2'], 4)
+
+class TestMainArgv(TempdirTestCase):
+    def test_main_parses_given_argv(self):
+        with patch('blasttax.sys') as msys:
+            msys.argv = ['blasttax', '--help']
+            blasttax.main(self.dmps + ['4'])
+            msys.stdout.write.assert_called_with(
+                'ordername(order) -> familyname(family)\n'
+            )
+
+class TestRefreshIndex(TempdirTestCase):
+    def setUp(self):
+        super(TestRefreshIndex, self).setUp()
+        self.indexpath = os.path.join(self.tempdir, 'taxonomy.idx')
+        blasttax.Phylogony(*self.dmps).save(self.indexpath)
+        newdir = os.path.join(self.tempdir, 'new')
+        os.mkdir(newdir)
+        # 3 is renamed, 2 moves under 5 and 7 is added below 2
+        names = names_dmp.replace('genusname', 'newgenus')
+        names += '7\t|\tsubspeciesname\t|\t\t|\tscientific name\t|\n'
+        nodes = nodes_dmp.replace('2\t|\t3\t|', '2\t|\t5\t|')
+        nodes += '7\t|\t2\t|\tsubspecies\t|\t\t|\t0\t|\t0\t|\t11\t|' \
+            '\t0\t|\t0\t|\t0\t|\t0\t|\t0\t|\t\t|\n'
+        # 6 is removed
+        names = '\n'.join(
+            l for l in names.splitlines() if not l.startswith('6\t')
+        ) + '\n'
+        nodes = '\n'.join(
+            l for l in nodes.splitlines() if not l.startswith('6\t')
+        ) + '\n'
+        self.newdmps = write_dmp_files(newdir, names, nodes)
+
+    def test_diff_finds_changes(self):
+        old = blasttax.Phylogony.load(self.indexpath)
+        new = blasttax.Phylogony(*self.newdmps)
+        r = blasttax.diff_taxonomy(old, new)
+        self.assertEqual(r.added, ['7'])
+        self.assertEqual(r.removed, ['6'])
+        self.assertEqual(r.reparented, ['2'])
+        self.assertEqual(r.renamed, ['3'])
+        self.assertEqual(r.modified, [])
+        self.assertFalse(r.divisions_changed)
+        self.assertIn('reparented\t2\t3 -> 5\n', r.report())
+        self.assertIn('renamed\t3\tgenusname -> newgenus\n', r.report())
+
+    def test_apply_diff_resets_jump_table(self):
+        p = blasttax.Phylogony.load(self.indexpath)
+        self.assertEqual(p.depth('2'), 4)
+        new = blasttax.Phylogony(*self.newdmps)
+        blasttax.apply_diff(p, blasttax.diff_taxonomy(p, new))
+        self.assertEqual(p.depth('7'), new.depth('7'))
+        self.assertEqual(p.depth('2'), new.depth('2'))
+        self.assertEqual(p.lca('7', '4'), new.lca('7', '4'))
+
+    def test_patches_index_in_place(self):
+        blasttax.refresh_index(self.indexpath, *self.newdmps)
+        r = blasttax.Phylogony.load(self.indexpath)
+        rebuilt = blasttax.Phylogony(*self.newdmps)
+        rebuilt._build_tree()
+        self.assertEqual(r.depths, rebuilt.depths)
+        self.assertEqual(sorted(r.nodeindex), sorted(rebuilt.nodeindex))
+        self.assertEqual(
+            dict((k, sorted(v)) for k, v in r.children.items() if v),
+            dict((k, sorted(v)) for k, v in rebuilt.children.items() if v)
+        )
+        self.assertEqual(
+            str(r['7']),
+            'subspeciesname(subspecies) -> Bacteria(species) -> '
+            'familyname(family)'
+        )
+        self.assertRaises(KeyError, r.__getitem__, '6')
+
+    def test_refreshes_read_only_indexes(self):
+        for indexer in (
+                blasttax.compact_index_dmpfile, blasttax.mmap_index_dmpfile):
+            blasttax.Phylogony(*self.dmps, indexer=indexer).save(self.indexpath)
+            blasttax.refresh_index(self.indexpath, *self.newdmps)
+            r = blasttax.Phylogony.load(self.indexpath)
+            self.assertEqual(
+                str(r['7']),
+                'subspeciesname(subspecies) -> Bacteria(species) -> '
+                'familyname(family)'
+            )
+            self.assertEqual(r.nameindex['3'][0].name, 'newgenus')
+
+    def test_only_parses_changed_taxids(self):
+        parsed = []
+        real_parse = blasttax.DmpLine.parse
+        def parse(self, dmpline, headers):
+            parsed.append(dmpline.split('\t')[0])
+            return real_parse(self, dmpline, headers)
+        with patch.object(blasttax.DmpLine, 'parse', parse):
+            diff = blasttax.refresh_index(self.indexpath, *self.newdmps)
+        self.assertEqual(set(parsed), set(['2', '3', '7']))
+        self.assertEqual(diff.renamed, ['3'])
+
+    def test_detects_dumps_overwritten_in_place(self):
+        blasttax.Phylogony(
+            *self.dmps, indexer=blasttax.mmap_index_dmpfile
+        ).save(self.indexpath)
+        for newpath, path in zip(self.newdmps, self.dmps):
+            shutil.copy(newpath, path)
+        diff = blasttax.refresh_index(self.indexpath, *self.dmps)
+        self.assertEqual(diff.added, ['7'])
+        self.assertEqual(diff.reparented, ['2'])
+
+    def test_refresh_without_changes_keeps_index(self):
+        with patch.object(blasttax.Phylogony, 'save') as save:
+            diff = blasttax.refresh_index(self.indexpath, *self.dmps)
+            self.assertEqual(0, len(diff))
+            self.assertEqual(0, save.call_count)
+
+    def test_only_recomputes_changed_subtrees(self):
+        with patch('blasttax.compute_depths') as mock_compute:
+            with patch('blasttax._walk_depth', wraps=blasttax._walk_depth) as walk:
+                blasttax.refresh_index(self.indexpath, *self.newdmps)
+                self.assertEqual(0, mock_compute.call_count)
+                self.assertEqual(
+                    set(['2', '7']),
+                    set(c[0][0] for c in walk.call_args_list)
+                )
+
+    def test_refresh_command_writes_report(self):
+        reportpath = os.path.join(self.tempdir, 'report.txt')
+        blasttax.main(
+            ['refresh', self.indexpath] + self.newdmps + ['--report', reportpath]
+        )
+        with open(reportpath) as fh:
+            report = fh.read()
+        self.assertIn('added\t7\tsubspeciesname\n', report)
+        self.assertIn('removed\t6\tAzorhizobium\n', report)
+
+class TestSqlitePhylogony(TempdirTestCase):
+    def setUp(self):
+        super(TestSqlitePhylogony, self).setUp()
+        self.dbpath = os.path.join(self.tempdir, 'taxonomy.sqlite')
+        blasttax.load_sqlite(self.dbpath, *self.dmps, batchsize=2)
+        self.inst = blasttax.SqlitePhylogony(self.dbpath)
+
+    def tearDown(self):
+        self.inst.close()
+        super(TestSqlitePhylogony, self).tearDown()
+
+    def test_builds_correct_phylogony(self):
+        r = self.inst['2']
+        self.assertEqual(
+            str(r),
+            'Bacteria(species) -> genusname(genus) -> '
+            'ordername(order) -> familyname(family)'
+        )
+        self.assertEqual(r.species[:2], ['Bacteria', 'Monera'])
+        self.assertEqual(r.genus, ['genusname'])
+
+    def test_no_taxid(self):
+        self.assertRaises(KeyError, self.inst.__getitem__, '99')
+        self.assertRaises(KeyError, self.inst.lineage, '99')
+
+    def test_lineage(self):
+        self.assertEqual(
+            self.inst.lineage('6'),
+            [('6', 'Azorhizobium', 'species'), ('1', 'root', 'no rank')]
+        )
+
+    def test_reload_replaces_tables(self):
+        blasttax.load_sqlite(self.dbpath, *self.dmps)
+        conn = self.inst._connection()
+        count = conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+        self.assertEqual(6, count)
+
+    def test_concurrent_lookups(self):
+        results = {}
+        def lookup(taxid):
+            results[taxid] = str(self.inst[taxid])
+        threads = [
+            threading.Thread(target=lookup, args=(taxid,))
+            for taxid in ('2', '3', '4', '5', '6')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results['6'], 'Azorhizobium(species)')
+        self.assertEqual(results['4'], 'ordername(order) -> familyname(family)')
+        self.assertEqual(6, len(self.inst._connections))
+
+    def test_sqlite_command(self):
+        dbpath = os.path.join(self.tempdir, 'cli.sqlite')
+        blasttax.main(['sqlite'] + self.dmps + [dbpath])
+        inst = blasttax.SqlitePhylogony(dbpath)
+        self.assertEqual(str(inst['6']), 'Azorhizobium(species)')
+        inst.close()
+
+class TestMmapDmpIndex(TempdirTestCase):
+    def setUp(self):
+        super(TestMmapDmpIndex, self).setUp()
+        namepath, nodepath, divpath = self.dmps
+        self.nameindex = blasttax.mmap_index_dmpfile(namepath, 'Name')
+        self.nodeindex = blasttax.mmap_index_dmpfile(nodepath, 'Node')
+        self.divindex = blasttax.mmap_index_dmpfile(divpath, 'Division')
+
+    def test_indexes_by_id(self):
+        r = self.nameindex['1']
+        self.assertEqual(r[0].id, '1')
+        self.assertEqual(r[0].name, 'all')
+        self.assertEqual(r[1].name, 'root')
+        self.assertEqual(r[1].name_class, 'scientific name')
+        self.assertEqual(8, len(self.nameindex['2']))
+        self.assertEqual(6, len(self.nameindex))
+        self.assertEqual(
+            sorted(self.nameindex), ['1', '2', '3', '4', '5', '6']
+        )
+
+    def test_integer_columns_do_not_decode_line(self):
+        r = self.nodeindex['4'][0]
+        self.assertEqual(r.parent_id, '5')
+        self.assertEqual(r.division, '0')
+        self.assertEqual(r._entry, None)
+        self.assertEqual(r.rank, 'order')
+        self.assertNotEqual(r._entry, None)
+
+    def test_missing_keys(self):
+        self.assertNotIn('99', self.nodeindex)
+        self.assertNotIn('foo', self.nodeindex)
+        self.assertRaises(KeyError, self.nodeindex.__getitem__, '99')
+        self.assertEqual(self.nodeindex.get('99'), None)
+
+    def test_unsorted_file(self):
+        path = os.path.join(self.tempdir, 'unsorted.dmp')
+        with open(path, 'w') as fh:
+            fh.write(''.join(reversed(nodes_dmp.splitlines(True))))
+        r = blasttax.mmap_index_dmpfile(path, 'Node')
+        self.assertEqual(r['2'][0].rank, 'species')
+        self.assertEqual(r['6'][0].parent_id, '1')
+
+    def test_same_values_as_index_dmpfile(self):
+        for index, path, dmptype in zip(
+                (self.nameindex, self.nodeindex, self.divindex),
+                self.dmps, ('Name', 'Node', 'Division')):
+            e = blasttax.index_dmpfile(path, dmptype)
+            self.assertEqual(sorted(e), sorted(index))
+            for key in e:
+                self.assertEqual(
+                    [l.values() for l in e[key]],
+                    [l.values() for l in index[key]]
+                )
+
+    def test_phylogony_with_mmap_indexer(self):
+        p = blasttax.Phylogony(*self.dmps, indexer=blasttax.mmap_index_dmpfile)
+        self.assertEqual(
+            str(p['2']),
+            'Bacteria(species) -> genusname(genus) -> '
+            'ordername(order) -> familyname(family)'
+        )
+        self.assertEqual(p['2'].genus, ['genusname'])
+        self.assertRaises(KeyError, p.__getitem__, '99')
+
+    def test_pickles(self):
+        r = pickle.loads(pickle.dumps(self.nodeindex))
+        self.assertEqual(r['4'][0].rank, 'order')
+        row = pickle.loads(pickle.dumps(self.nodeindex['4'][0]))
+        self.assertTrue(isinstance(row, blasttax.Node))
+        self.assertEqual(row.rank, 'order')
+
+    def test_empty_file(self):
+        path = os.path.join(self.tempdir, 'empty.dmp')
+        open(path, 'w').close()
+        r = blasttax.mmap_index_dmpfile(path, 'Name')
+        self.assertEqual(0, len(r))
+
+class TestAncestors(unittest.TestCase):
+    def setUp(self):
+        self.divfh = MagicMock()
+        self.nodefh = MagicMock()
+        self.namefh = MagicMock()
+        self.namefh.__enter__.return_value = names_dmp.splitlines()
+        self.nodefh.__enter__.return_value = nodes_dmp.splitlines()
+        self.divfh.__enter__.return_value = div_dmp.splitlines()
+        self.inst = blasttax.Phylogony(self.namefh, self.nodefh, self.divfh)
+
+    def test_depth(self):
+        self.assertEqual(self.inst.depth('2'), 4)
+        self.assertEqual(self.inst.depth('1'), 0)
+
+    def test_ancestor(self):
+        self.assertEqual(self.inst.ancestor('2', 0), '2')
+        self.assertEqual(self.inst.ancestor('2', 1), '3')
+        self.assertEqual(self.inst.ancestor('2', 3), '5')
+        self.assertEqual(self.inst.ancestor('2', 4), '1')
+        self.assertRaises(ValueError, self.inst.ancestor, '2', 5)
+        self.assertRaises(KeyError, self.inst.ancestor, '99', 1)
+
+    def test_lca_and_distance(self):
+        self.assertEqual(self.inst.lca('2', '4'), '4')
+        self.assertEqual(self.inst.lca('2', '6'), '1')
+        self.assertEqual(self.inst.distance('2', '4'), 2)
+        self.assertEqual(self.inst.distance('2', '6'), 5)
+        self.assertEqual(self.inst.distance('6', '6'), 0)
+
+    def test_distance_matrix(self):
+        r = self.inst.distance_matrix(['2', '4', '6'])
+        self.assertEqual(r, [[0, 2, 5], [2, 0, 3], [5, 3, 0]])
+
+    def test_different_trees(self):
+        self.inst._build_indexes()
+        self.inst.nodeindex['5'][0].parent_id = '5'
+        self.assertRaises(ValueError, self.inst.distance, '2', '6')
+        self.assertRaises(ValueError, self.inst.lca, '2', '6')
+
+    def test_matches_walking_random_tree(self):
+        rng = random.Random(42)
+        lines = ['1\t|\t1\t|\tno rank\t|\t\t|\t8\t|']
+        parents = {'1': '1'}
+        for i in range(2, 500):
+            parent = str(rng.randint(1, i - 1))
+            parents[str(i)] = parent
+            lines.append('{0}\t|\t{1}\t|\tno rank\t|\t\t|\t8\t|'.format(i, parent))
+        lines = [l + '\t0\t|' * 7 + '\t\t|' for l in lines]
+        self.nodefh.__enter__.return_value = lines
+        def path(taxid):
+            p = [taxid]
+            while parents[p[-1]] != p[-1]:
+                p.append(parents[p[-1]])
+            return p
+        for x in range(200):
+            a = str(rng.randint(1, 499))
+            b = str(rng.randint(1, 499))
+            pa, pb = path(a), path(b)
+            common = [t for t in pa if t in pb][0]
+            self.assertEqual(self.inst.lca(a, b), common)
+            self.assertEqual(
+                self.inst.distance(a, b),
+                pa.index(common) + pb.index(common)
+            )
+            k = rng.randint(0, len(pa) - 1)
+            self.assertEqual(self.inst.ancestor(a, k), pa[k])
+
+class TestPruneTaxonomy(TempdirTestCase):
+    def setUp(self):
+        super(TestPruneTaxonomy, self).setUp()
+        self.inst = blasttax.Phylogony(*self.dmps)
+        self.outdir = os.path.join(self.tempdir, 'pruned')
+        os.mkdir(self.outdir)
+
+    def test_ancestor_closure(self):
+        r = blasttax.ancestor_closure(self.inst, ['3', '6'])
+        self.assertEqual(r, set(['1', '3', '4', '5', '6']))
+        self.assertRaises(
+            KeyError, blasttax.ancestor_closure, self.inst, ['99']
+        )
+
+    def test_dmpline_format_roundtrip(self):
+        for line in nodes_dmp.splitlines(True):
+            self.assertEqual(blasttax.Node(line).format(), line)
+
+    def test_writes_pruned_dmp_files(self):
+        blasttax.write_pruned_taxonomy(self.inst, ['4'], self.outdir)
+        with open(os.path.join(self.outdir, 'nodes.dmp')) as fh:
+            nodes = fh.read()
+        with open(os.path.join(self.outdir, 'division.dmp')) as fh:
+            divs = fh.read()
+        self.assertEqual(
+            nodes,
+            ''.join(l for l in nodes_dmp.splitlines(True) if l[0] in '145')
+        )
+        self.assertEqual(
+            divs,
+            ''.join(l for l in div_dmp.splitlines(True) if l[0] in '08')
+        )
+
+    def test_pruned_taxonomy_gives_same_lineages(self):
+        blasttax.write_pruned_taxonomy(self.inst, ['2', '6'], self.outdir)
+        paths = [
+            os.path.join(self.outdir, f)
+            for f in ('names.dmp', 'nodes.dmp', 'division.dmp')
+        ]
+        pruned = blasttax.Phylogony(*paths)
+        compiled = blasttax.Phylogony.load(
+            os.path.join(self.outdir, 'taxonomy.idx')
+        )
+        for taxid in ('2', '6'):
+            self.assertEqual(str(pruned[taxid]), str(self.inst[taxid]))
+            self.assertEqual(pruned[taxid].ranks, self.inst[taxid].ranks)
+            self.assertEqual(str(compiled[taxid]), str(self.inst[taxid]))
+
+    def test_prune_command(self):
+        taxidfile = os.path.join(self.tempdir, 'taxids.txt')
+        with open(taxidfile, 'w') as fh:
+            fh.write('6\n\n')
+        outdir = os.path.join(self.tempdir, 'cli')
+        blasttax.main(['prune'] + self.dmps + [taxidfile, outdir, '--no-index'])
+        self.assertEqual(
+            sorted(os.listdir(outdir)),
+            ['division.dmp', 'names.dmp', 'nodes.dmp']
+        )
+
+class TestValidate(TempdirTestCase):
+    def validate(self, names=names_dmp, nodes=nodes_dmp, divs=div_dmp):
+        outdir = tempfile.mkdtemp(dir=self.tempdir)
+        dmps = write_dmp_files(outdir, names, nodes, divs)
+        return blasttax.Phylogony(*dmps).validate()
+
+    def test_valid_taxonomy(self):
+        r = self.validate()
+        self.assertEqual(0, len(r))
+        self.assertEqual([], r.report())
+
+    def test_finds_orphans(self):
+        r = self.validate(nodes=nodes_dmp.replace('4\t|\t5\t|', '4\t|\t50\t|'))
+        self.assertEqual(r.orphans, ['4'])
+        self.assertEqual(r.unreachable, ['2', '3', '4'])
+        self.assertIn('orphans\t4\tparent 50 missing\n', r.report())
+
+    def test_finds_cycles(self):
+        r = self.validate(nodes=nodes_dmp.replace('5\t|\t1\t|', '5\t|\t3\t|'))
+        self.assertEqual(len(r.cycles), 1)
+        self.assertEqual(sorted(r.cycles[0]), ['3', '4', '5'])
+        self.assertEqual(r.unreachable, ['2', '3', '4', '5'])
+        self.assertEqual(r.orphans, [])
+
+    def test_finds_roots_not_named_all(self):
+        r = self.validate(names=names_dmp.replace('1\t|\tall', '1\t|\tnotall'))
+        self.assertEqual(r.bad_roots, ['1'])
+        self.assertEqual(r.unreachable, ['1', '2', '3', '4', '5', '6'])
+
+    def test_only_roots_are_checked_for_all(self):
+        r = self.validate(
+            names=names_dmp.replace('5\t|\tfamilyname', '5\t|\tall'),
+            nodes=nodes_dmp.replace('5\t|\t1\t|', '5\t|\t3\t|')
+        )
+        self.assertEqual(len(r.cycles), 1)
+        self.assertEqual(r.unreachable, ['2', '3', '4', '5'])
+
+    def test_validates_array_columns(self):
+        p = blasttax.Phylogony(
+            *write_dmp_files(
+                tempfile.mkdtemp(dir=self.tempdir), names_dmp,
+                nodes_dmp.replace('4\t|\t5\t|', '4\t|\t50\t|'), div_dmp
+            ), indexer=blasttax.mmap_index_dmpfile
+        )
+        p._build_indexes()
+        with patch('blasttax._MmapRow', wraps=blasttax._MmapRow) as row:
+            r = p.validate()
+        for call in row.call_args_list:
+            self.assertIsNot(call[0][0], p.nodeindex)
+        self.assertEqual(r.orphans, ['4'])
+
+    def test_finds_unknown_divisions_and_unnamed_nodes(self):
+        names = '\n'.join(
+            l for l in names_dmp.splitlines() if not l.startswith('5\t')
+        ) + '\n'
+        r = self.validate(names=names, divs=div_dmp.replace('8\t|\tUNA', '80\t|\tUNA'))
+        self.assertEqual(r.unknown_divisions, ['1'])
+        self.assertEqual(r.unnamed, ['5'])
+        self.assertEqual(r.unreachable, [])
+
+    def test_validate_command(self):
+        with patch('blasttax.sys') as msys:
+            self.assertEqual(0, blasttax.main(['validate'] + self.dmps))
+            outdir = tempfile.mkdtemp(dir=self.tempdir)
+            dmps = write_dmp_files(
+                outdir, nodes=nodes_dmp.replace('4\t|\t5\t|', '4\t|\t50\t|')
+            )
+            self.assertEqual(1, blasttax.main(['validate'] + dmps))
+            lines = msys.stdout.writelines.call_args[0][0]
+            self.assertIn('orphans\t4\tparent 50 missing\n', lines)
+
+    def test_compile_refuses_invalid_taxonomy(self):
+        dmps = write_dmp_files(
+            tempfile.mkdtemp(dir=self.tempdir),
+            nodes=nodes_dmp.replace('4\t|\t5\t|', '4\t|\t50\t|')
+        )
+        indexpath = os.path.join(self.tempdir, 'taxonomy.idx')
+        with patch('blasttax.sys'):
+            r = blasttax.main(['compile'] + dmps + [indexpath, '--validate'])
+        self.assertEqual(1, r)
+        self.assertFalse(os.path.exists(indexpath))
+
+# Index read by _sidecar_names_worker. Set by _init_sidecar_worker
+_sidecar_index = None
+
+def _init_sidecar_worker(index):
+    global _sidecar_index
+    _sidecar_index = index
+
+def _sidecar_names_task(index, taxids):
+    return [name.name for taxid in taxids for name in index[taxid]]
+
+def _sidecar_names_worker(taxids):
+    return _sidecar_names_task(_sidecar_index, taxids)
+
+class TestSidecarDmpIndex(TempdirTestCase):
+    def setUp(self):
+        super(TestSidecarDmpIndex, self).setUp()
+        # Reverse the taxids so that offsets are not in taxid order
+        self.namepath = self.dmps[0]
+        with open(self.namepath, 'w') as fh:
+            fh.write(''.join(sorted(
+                names_dmp.splitlines(True), key=lambda l: -int(l.split('\t')[0])
+            )))
+        self.index = blasttax.sidecar_index_dmpfile(self.namepath, 'Name')
+
+    def tearDown(self):
+        self.index.close()
+        super(TestSidecarDmpIndex, self).tearDown()
+
+    def test_builds_sidecar(self):
+        self.assertTrue(
+            os.path.exists(blasttax.sidecar_path(self.namepath))
+        )
+        self.assertEqual(6, len(self.index))
+        self.assertEqual(sorted(self.index), ['1', '2', '3', '4', '5', '6'])
+
+    def test_looks_up_lines(self):
+        e = blasttax.index_dmpfile(self.namepath, 'Name')
+        for taxid in e:
+            self.assertEqual(
+                sorted(l.values() for l in e[taxid]),
+                sorted(l.values() for l in self.index[taxid])
+            )
+        self.assertIn('6', self.index)
+        self.assertNotIn('7', self.index)
+        self.assertNotIn('foo', self.index)
+        self.assertRaises(KeyError, self.index.__getitem__, '0')
+
+    def test_rebuilds_stale_sidecar(self):
+        with open(self.namepath, 'a') as fh:
+            fh.write('7\t|\tnewname\t|\t\t|\tscientific name\t|\n')
+        os.utime(self.namepath, (0, 0))
+        r = blasttax.sidecar_index_dmpfile(self.namepath, 'Name')
+        self.assertEqual(r['7'][0].name, 'newname')
+        r.close()
+
+    def test_rebuilds_sidecar_rewritten_within_a_second(self):
+        # Same size but every line moves
+        st = os.stat(self.namepath)
+        with open(self.namepath, 'w') as fh:
+            fh.write(names_dmp)
+        os.utime(self.namepath, (st.st_atime, int(st.st_mtime) + 0.5))
+        r = blasttax.sidecar_index_dmpfile(self.namepath, 'Name')
+        self.assertEqual(r['2'][0].name, 'Bacteria')
+        self.assertEqual(r['6'][0].name, 'Azorhizobium')
+        r.close()
+
+    def test_falls_back_to_cache_directory(self):
+        os.remove(blasttax.sidecar_path(self.namepath))
+        cachedir = os.path.join(self.tempdir, 'cache')
+        real_build = blasttax.build_sidecar
+        def build(dmppath, path=None):
+            if path == blasttax.sidecar_path(dmppath):
+                raise OSError(13, 'Permission denied')
+            return real_build(dmppath, path)
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': cachedir}):
+            with patch('blasttax.build_sidecar', side_effect=build):
+                r = blasttax.sidecar_index_dmpfile(self.namepath, 'Name')
+                self.assertEqual(r['6'][0].name, 'Azorhizobium')
+                r.close()
+                self.assertTrue(r.sidecar.startswith(cachedir))
+            with patch('blasttax.build_sidecar') as build:
+                r = blasttax.sidecar_index_dmpfile(self.namepath, 'Name')
+                r.close()
+                self.assertEqual(0, build.call_count)
+
+    def test_reuses_sidecar(self):
+        with patch('blasttax.build_sidecar') as build:
+            r = blasttax.sidecar_index_dmpfile(self.namepath, 'Name')
+            r.close()
+            self.assertEqual(0, build.call_count)
+
+    def test_lineage_only_reads_needed_lines(self):
+        p = blasttax.Phylogony(
+            *self.dmps, indexer=blasttax.sidecar_index_dmpfile
+        )
+        p._build_indexes()
+        with patch.object(
+                p.nodeindex, '_line', wraps=p.nodeindex._line) as line:
+            r = str(p['4'])
+        offsets = [c[0][0] for c in line.call_args_list]
+        self.assertEqual(r, 'ordername(order) -> familyname(family)')
+        with open(self.dmps[1], 'rb') as fh:
+            nodes = fh.read()
+        read = set(nodes[offset:].split(b'\t')[0] for offset in offsets)
+        self.assertEqual(read, set([b'1', b'4', b'5']))
+
+    def test_lookups_from_forked_workers(self):
+        # Large enough that lookups miss the read buffer of a file handle
+        path = os.path.join(self.tempdir, 'many_names.dmp')
+        with open(path, 'w') as fh:
+            for taxid in range(1, 20001):
+                fh.write(
+                    '{0}\t|\tname {0}\t|\t\t|\tscientific name\t|\n'
+                    .format(taxid)
+                )
+        r = blasttax.sidecar_index_dmpfile(path, 'Name')
+        tasks = [
+            [str(taxid) for taxid in range(i, 20001, 97)]
+            for i in range(1, 201)
+        ]
+        expected = [_sidecar_names_task(r, task) for task in tasks]
+        # Workers inherit the parent's open index and read it concurrently
+        result = list(blasttax.ordered_imap(
+            _sidecar_names_worker, tasks, 4, _init_sidecar_worker, (r,)
+        ))
+        r.close()
+        self.assertEqual(result, expected)
+
+class TestAnnotateBlast(TempdirTestCase):
+    def setUp(self):
+        super(TestAnnotateBlast, self).setUp()
+        self.inst = blasttax.Phylogony(*self.dmps)
+        self.lines = []
+        for i in range(200):
+            taxid = ['2', '4', '6', '99', '2;6'][i % 5]
+            self.lines.append(
+                'query{0}\tsubject\t99.0\t100\t0\t0\t1\t100\t1\t100'
+                '\t1e-50\t200\t{1}\n'.format(i, taxid)
+            )
+        self.blastpath = os.path.join(self.tempdir, 'blast.tsv')
+        with open(self.blastpath, 'w') as fh:
+            fh.writelines(self.lines)
+
+    def expected(self):
+        lineages = {
+            '2': str(self.inst['2']), '4': str(self.inst['4']),
+            '6': str(self.inst['6']), '99': '', '2;6': str(self.inst['2']),
+        }
+        return ''.join(
+            l.rstrip('\n') + '\t' + lineages[l.split('\t')[12].strip()] + '\n'
+            for l in self.lines
+        ).encode('utf-8')
+
+    def test_shard_file_aligns_to_lines(self):
+        shards = blasttax.shard_file(self.blastpath, 100)
+        with open(self.blastpath, 'rb') as fh:
+            data = fh.read()
+        self.assertEqual(shards[0][0], 0)
+        self.assertEqual(shards[-1][1], len(data))
+        for start, end in shards:
+            self.assertTrue(start == 0 or data[start - 1:start] == b'\n')
+            self.assertTrue(end > start)
+
+    def test_annotates_in_process(self):
+        out = io.BytesIO()
+        blasttax.annotate_blast(
+            self.inst, self.blastpath, out, 13, processes=1, chunksize=500
+        )
+        self.assertEqual(out.getvalue(), self.expected())
+
+    def test_annotates_in_order_with_processes(self):
+        out = io.BytesIO()
+        blasttax.annotate_blast(
+            self.inst, self.blastpath, out, 13, processes=3, chunksize=500
+        )
+        self.assertEqual(out.getvalue(), self.expected())
+
+    def test_annotates_gzip(self):
+        gzpath = self.blastpath + '.gz'
+        with gzip.open(gzpath, 'wb') as fh:
+            fh.write(''.join(self.lines).encode('utf-8'))
+        out = io.BytesIO()
+        blasttax.annotate_blast(
+            self.inst, gzpath, out, 13, processes=2, chunksize=500
+        )
+        self.assertEqual(out.getvalue(), self.expected())
+
+    def test_phylogony_pickles(self):
+        self.inst._build_indexes()
+        r = pickle.loads(pickle.dumps(self.inst))
+        self.assertEqual(str(r['2']), str(self.inst['2']))
+
+    def test_annotate_command(self):
+        outpath = os.path.join(self.tempdir, 'out.tsv')
+        blasttax.main(
+            ['annotate'] + self.dmps +
+            [self.blastpath, '-o', outpath, '-p', '2', '--chunk-size', '1000']
+        )
+        with open(outpath, 'rb') as fh:
+            self.assertEqual(fh.read(), self.expected())
+
+def blast_line(query, taxid, score):
+    return '{0}\tsubject\t99.0\t100\t0\t0\t1\t100\t1\t100\t1e-50' \
+        '\t{1}\t{2}\n'.format(query, score, taxid).encode('utf-8')
+
+class TestGroupLines(TempdirTestCase):
+    def setUp(self):
+        super(TestGroupLines, self).setUp()
+        rng = random.Random(1)
+        self.lines = [
+            '{0}\t{1}\n'.format(rng.randint(0, 20), i).encode('utf-8')
+            for i in range(300)
+        ]
+        self.expected = collections.defaultdict(list)
+        for line in self.lines:
+            self.expected[line.split(b'\t')[0]].append(line)
+
+    def keyfunc(self, line):
+        return line.split(b'\t')[0]
+
+    def test_groups_in_memory(self):
+        r = list(blasttax.group_lines(self.lines, self.keyfunc))
+        self.assertEqual(dict(r), self.expected)
+        self.assertEqual([k for k, v in r], sorted(self.expected))
+
+    @patch('blasttax.merge_width', 3)
+    def test_merges_runs_in_bounded_passes(self):
+        opened = []
+        def spill(buffer, keyfunc, tmpdir):
+            run = real_spill(buffer, keyfunc, tmpdir)
+            opened.append(run)
+            self.assertTrue(sum(not f.closed for f in opened) <= 7)
+            return run
+        real_spill = blasttax._spill_run
+        with patch('blasttax._spill_run', side_effect=spill):
+            r = list(blasttax.group_lines(
+                self.lines, self.keyfunc, max_memory=500, tmpdir=self.tempdir
+            ))
+        self.assertTrue(len(opened) > 20)
+        self.assertEqual(dict(r), self.expected)
+        self.assertEqual([k for k, v in r], sorted(self.expected))
+
+    def test_groups_with_spilled_runs(self):
+        with patch('blasttax._spill_run', wraps=blasttax._spill_run) as spill:
+            r = list(blasttax.group_lines(
+                self.lines, self.keyfunc, max_memory=1000, tmpdir=self.tempdir
+            ))
+            self.assertTrue(spill.call_count > 5)
+        self.assertEqual(dict(r), self.expected)
+        self.assertEqual([k for k, v in r], sorted(self.expected))
+
+class TestClassifyQueries(TempdirTestCase):
+    def setUp(self):
+        super(TestClassifyQueries, self).setUp()
+        self.inst = blasttax.Phylogony(*self.dmps)
+        self.hits = [
+            blast_line('q1', '2', 100), blast_line('q1', '4', 200),
+            blast_line('q1', '3', 50), blast_line('q1', '99', 500),
+        ]
+
+    def test_best(self):
+        r = blasttax.resolve_hits(self.inst, self.hits, 'best')
+        self.assertEqual(r, '4')
+
+    def test_lca(self):
+        r = blasttax.resolve_hits(self.inst, self.hits, 'lca')
+        self.assertEqual(r, '4')
+        r = blasttax.resolve_hits(
+            self.inst, self.hits + [blast_line('q1', '6', 1)], 'lca'
+        )
+        self.assertEqual(r, '1')
+
+    def test_consensus(self):
+        hits = self.hits + [blast_line('q1', '6', 1)]
+        self.assertEqual(blasttax.resolve_hits(self.inst, hits, 'consensus'), '3')
+        self.assertEqual(
+            blasttax.resolve_hits(self.inst, hits, 'consensus', consensus=0.7),
+            '4'
+        )
+        self.assertEqual(
+            blasttax.resolve_hits(self.inst, hits, 'consensus', consensus=1.0),
+            '1'
+        )
+
+    def test_lca_of_disjoint_trees(self):
+        with patch.object(self.inst, 'lca', side_effect=ValueError):
+            r = blasttax.resolve_hits(self.inst, self.hits, 'lca')
+        self.assertEqual(r, None)
+
+    def test_no_known_taxids(self):
+        r = blasttax.resolve_hits(self.inst, [blast_line('q', '99', 1)])
+        self.assertEqual(r, None)
+
+    def test_invalid_method(self):
+        self.assertRaises(
+            ValueError, blasttax.resolve_hits, self.inst, self.hits, 'foo'
+        )
+
+    def test_classifies_interleaved_queries(self):
+        lines = [
+            blast_line('q2', '6', 10), blast_line('q1', '2', 10),
+            blast_line('q3', '99', 10), blast_line('q2', '6', 10),
+            blast_line('q1', '4', 10),
+        ]
+        out = io.BytesIO()
+        blasttax.classify_queries(
+            self.inst, lines, out, max_memory=100, tmpdir=self.tempdir
+        )
+        self.assertEqual(
+            out.getvalue().decode('utf-8').splitlines(),
+            [
+                'q1\t4\tordername(order) -> familyname(family)',
+                'q2\t6\tAzorhizobium(species)',
+                'q3\t\t',
+            ]
+        )
+
+    def test_parse_size(self):
+        self.assertEqual(blasttax.parse_size('512'), 512)
+        self.assertEqual(blasttax.parse_size('2K'), 2048)
+        self.assertEqual(blasttax.parse_size('1.5g'), 1536 * 1024 ** 2)
+
+    def test_classify_command(self):
+        blastpath = os.path.join(self.tempdir, 'blast.tsv.gz')
+        with gzip.open(blastpath, 'wb') as fh:
+            fh.write(b''.join(self.hits))
+        outpath = os.path.join(self.tempdir, 'out.tsv')
+        blasttax.main(
+            ['classify'] + self.dmps +
+            [blastpath, '-o', outpath, '--method', 'best', '--max-memory', '1K']
+        )
+        with open(outpath) as fh:
+            self.assertEqual(
+                fh.read(), 'q1\t4\tordername(order) -> familyname(family)\n'
+            )
+
+class TestAbundanceMatrix(TempdirTestCase):
+    def setUp(self):
+        super(TestAbundanceMatrix, self).setUp()
+        self.inst = blasttax.Phylogony(*self.dmps)
+        self.samples = []
+        for i, contents in enumerate((
+                '2\t5\n4\t1\n99\t3\n', '6\t2\n2\t1\n2\n', '3\t4\n')):
+            path = os.path.join(self.tempdir, 'sample{0}.tsv'.format(i))
+            with open(path, 'w') as fh:
+                fh.write(contents)
+            self.samples.append(path)
+        self.prefix = os.path.join(self.tempdir, 'matrix')
+
+    def read_matrix(self):
+        with open(self.prefix + '.rows.tsv') as fh:
+            rows = dict(
+                (l.split('\t')[0], l.split('\t')[1]) for l in fh
+            )
+        with open(self.prefix + '.cols.tsv') as fh:
+            cols = [l.rstrip('\n').split('\t')[1] for l in fh]
+        matrix = {}
+        with open(self.prefix + '.triplets.tsv') as fh:
+            for line in fh:
+                row, col, count = line.split('\t')
+                matrix[(rows[row], cols[int(col)])] = int(count)
+        return matrix
+
+    def test_reads_counts(self):
+        r = blasttax.read_counts(self.samples[1])
+        self.assertEqual(r, {'6': 2, '2': 2})
+
+    def test_rolls_counts_up_lineages(self):
+        r = blasttax.build_abundance_matrix(
+            self.inst, self.samples, self.prefix, processes=2
+        )
+        self.assertEqual(r['unknown'], 3)
+        self.assertEqual(r['samples'], 3)
+        m = self.read_matrix()
+        self.assertEqual(m[('2', 'sample0.tsv')], 5)
+        self.assertEqual(m[('4', 'sample0.tsv')], 6)
+        self.assertEqual(m[('5', 'sample0.tsv')], 6)
+        self.assertEqual(m[('6', 'sample1.tsv')], 2)
+        self.assertEqual(m[('5', 'sample1.tsv')], 2)
+        self.assertEqual(m[('3', 'sample2.tsv')], 4)
+        self.assertNotIn(('2', 'sample2.tsv'), m)
+        self.assertEqual(len(m), r['entries'])
+
+    def test_resolves_each_taxid_once(self):
+        for processes in (1, 2):
+            with patch.object(
+                    blasttax.Phylogony, '__getitem__', autospec=True,
+                    side_effect=blasttax.Phylogony.__getitem__) as get:
+                blasttax.build_abundance_matrix(
+                    self.inst, self.samples, self.prefix, processes=processes
+                )
+                self.assertEqual(
+                    sorted(c[0][1] for c in get.call_args_list),
+                    ['2', '3', '4', '6', '99']
+                )
+            m = self.read_matrix()
+            self.assertEqual(m[('5', 'sample1.tsv')], 2)
+
+    def test_rows_use_scientific_names(self):
+        write_dmp_files(self.tempdir, names=synonym_first_names_dmp)
+        inst = blasttax.Phylogony(*self.dmps)
+        blasttax.build_abundance_matrix(
+            inst, self.samples, self.prefix, processes=1
+        )
+        with open(self.prefix + '.rows.tsv') as fh:
+            labels = [l.rstrip('\n').split('\t')[1:] for l in fh]
+        self.assertIn(['6', 'species', 'Azorhizobium'], labels)
+
+    def test_only_given_ranks(self):
+        blasttax.build_abundance_matrix(
+            self.inst, self.samples, self.prefix, ['order'], processes=1
+        )
+        m = self.read_matrix()
+        self.assertEqual(
+            m, {('4', 'sample0.tsv'): 6, ('4', 'sample1.tsv'): 2,
+                ('4', 'sample2.tsv'): 4}
+        )
+
+    def test_abundance_command(self):
+        listpath = os.path.join(self.tempdir, 'samples.txt')
+        with open(listpath, 'w') as fh:
+            fh.write('\n'.join(self.samples[1:]) + '\n')
+        blasttax.main(
+            ['abundance'] + self.dmps + [self.samples[0], '--sample-list',
+             listpath, '-o', self.prefix, '--ranks', 'genus,order', '-p', '2']
+        )
+        m = self.read_matrix()
+        self.assertEqual(m[('3', 'sample2.tsv')], 4)
+        self.assertEqual(m[('4', 'sample1.tsv')], 2)
+
+class TestLineageFormatter(TempdirTestCase):
+    def setUp(self):
+        super(TestLineageFormatter, self).setUp()
+        self.dmps = write_dmp_files(
+            self.tempdir, names=synonym_first_names_dmp
+        )
+        self.inst = blasttax.Phylogony(*self.dmps)
+
+    def format(self, fmt, taxid='4'):
+        return blasttax.LineageFormatter(self.inst, fmt).format(taxid)
+
+    def test_text(self):
+        self.assertEqual(self.format('text'), str(self.inst['4']).encode('utf-8'))
+
+    def test_tsv(self):
+        self.assertEqual(
+            self.format('tsv'), b'4\tordername\torder\tfamilyname;ordername'
+        )
+
+    def test_ndjson(self):
+        r = json.loads(self.format('ndjson').decode('utf-8'))
+        self.assertEqual(r['taxid'], '4')
+        self.assertEqual(r['rank'], 'order')
+        self.assertEqual(
+            [l['name'] for l in r['lineage']], ['ordername', 'familyname']
+        )
+
+    def test_ranked(self):
+        self.assertEqual(
+            self.format('ranked', '2'),
+            b'family:familyname;order:ordername;genus:genusname;'
+            b'species:Bacteria'
+        )
+
+    def test_krona(self):
+        self.assertEqual(self.format('krona'), b'familyname\tordername')
+
+    def test_uses_scientific_name(self):
+        self.assertEqual(
+            self.format('tsv', '6'), b'6\tAzorhizobium\tspecies\tAzorhizobium'
+        )
+        self.assertEqual(
+            self.format('text', '6'), str(self.inst['6']).encode('utf-8')
+        )
+
+    def test_unknown_taxid(self):
+        self.assertEqual(self.format('tsv', '99'), b'')
+
+    def test_invalid_format(self):
+        self.assertRaises(
+            ValueError, blasttax.LineageFormatter, self.inst, 'xml'
+        )
+
+    def test_formats_each_taxid_once(self):
+        formatter = blasttax.LineageFormatter(self.inst, 'tsv')
+        with patch.object(formatter, '_encode', wraps=formatter._encode) as enc:
+            for i in range(5):
+                formatter.format('2')
+                formatter.format('4')
+            self.assertEqual(2, enc.call_count)
+
+    def test_annotate_with_format(self):
+        blastpath = os.path.join(self.tempdir, 'blast.tsv')
+        with open(blastpath, 'wb') as fh:
+            fh.write(blast_line('q1', '4', 10))
+        out = io.BytesIO()
+        blasttax.annotate_blast(
+            self.inst, blastpath, out, 13, processes=1, fmt='ranked'
+        )
+        self.assertTrue(
+            out.getvalue().endswith(b'\t4\tfamily:familyname;order:ordername\n')
+        )
+
+class TestCompactDmpIndex(TempdirTestCase):
+    def setUp(self):
+        super(TestCompactDmpIndex, self).setUp()
+        self.nameindex = blasttax.compact_index_dmpfile(self.dmps[0], 'Name')
+
+    def test_same_values_as_index_dmpfile(self):
+        for path, dmptype in zip(self.dmps, ('Name', 'Node', 'Division')):
+            e = blasttax.index_dmpfile(path, dmptype)
+            r = blasttax.compact_index_dmpfile(path, dmptype)
+            self.assertEqual(sorted(e), sorted(r))
+            self.assertEqual(len(e), len(r))
+            for key in e:
+                self.assertEqual(
+                    [l.values() for l in e[key]], [l.values() for l in r[key]]
+                )
+        self.assertNotIn('99', self.nameindex)
+        self.assertRaises(KeyError, self.nameindex.__getitem__, 'x')
+
+    def test_encodes_categorical_columns(self):
+        self.assertEqual(
+            self.nameindex.categories['name_class'],
+            ['synonym', 'scientific name', 'in-part', 'blast name',
+             'genbank common name', '', 'equivalent name']
+        )
+        self.assertEqual(self.nameindex.columns['name_class'].typecode, 'H')
+
+    def test_patched(self):
+        changes = {
+            '3': [blasttax.Name(['3', 'newgenus', '', 'scientific name'])],
+            '7': [blasttax.Name(['7', 'added', '', 'type material'])],
+            '5': [],
+        }
+        r = self.nameindex.patched(changes)
+        self.assertEqual(sorted(r), ['1', '2', '3', '4', '6', '7'])
+        self.assertEqual(len(r), 6)
+        self.assertEqual(r['3'][0].values(), changes['3'][0].values())
+        self.assertEqual(r['7'][0].name_class, 'type material')
+        self.assertEqual(
+            [l.values() for l in r['2']],
+            [l.values() for l in self.nameindex['2']]
+        )
+        self.assertNotIn('5', r)
+        self.assertIn('5', self.nameindex)
+
+    def test_deduplicates_strings(self):
+        names = (
+            '7\t|\tsame\t|\t\t|\tsynonym\t|\n'
+            '8\t|\tsame\t|\t\t|\tsynonym\t|\n'
+        )
+        path = os.path.join(self.tempdir, 'dup.dmp')
+        with open(path, 'w') as fh:
+            fh.write(names)
+        r = blasttax.compact_index_dmpfile(path, 'Name')
+        # same and the empty unique name
+        self.assertEqual(2, len(r.strings))
+        self.assertEqual(b'same', r.strings.heap)
+        self.assertEqual(r['8'][0].name, 'same')
+
+    def test_interns_categorical_values(self):
+        a = blasttax.Name(names_dmp.splitlines()[1])
+        b = blasttax.Name(names_dmp.splitlines()[2])
+        self.assertTrue(a.name_class is b.name_class)
+
+    def test_phylogony_with_compact_indexer(self):
+        p = blasttax.Phylogony(
+            *self.dmps, indexer=blasttax.compact_index_dmpfile
+        )
+        self.assertEqual(
+            str(p['2']),
+            'Bacteria(species) -> genusname(genus) -> '
+            'ordername(order) -> familyname(family)'
+        )
+        indexpath = os.path.join(self.tempdir, 'taxonomy.idx')
+        p.save(indexpath)
+        r = blasttax.Phylogony.load(indexpath)
+        self.assertTrue(isinstance(r.nameindex, blasttax.CompactDmpIndex))
+        self.assertEqual(str(r['6']), 'Azorhizobium(species)')
+
+@unittest.skipIf(blasttax.numpy is None, 'numpy is not installed')
+class TestArrays(TempdirTestCase):
+    def setUp(self):
+        super(TestArrays, self).setUp()
+        self.inst = blasttax.Phylogony(*self.dmps)
+
+    def test_to_arrays(self):
+        r = self.inst.to_arrays()
+        self.assertEqual(list(r['taxid']), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(r['parent']), [1, 3, 4, 5, 1, 1])
+        self.assertEqual(list(r['depth']), [0, 4, 3, 2, 1, 1])
+        self.assertEqual(
+            [r['rank_labels'][code] for code in r['rank']],
+            ['no rank', 'species', 'genus', 'order', 'family', 'species']
+        )
+        offsets = r['name_offsets']
+        heap = r['name_heap'].tobytes()
+        self.assertEqual(
+            [heap[offsets[i]:offsets[i + 1]] for i in range(6)],
+            [b'root', b'Bacteria', b'genusname', b'ordername', b'familyname',
+             b'Azorhizobium']
+        )
+        self.assertEqual(list(r['division_codes'][:2]), ['BCT', 'INV'])
+
+    def test_from_arrays_gives_same_lineages(self):
+        r = blasttax.Phylogony.from_arrays(self.inst.to_arrays())
+        for taxid in ('1', '2', '3', '4', '5', '6'):
+            self.assertEqual(str(r[taxid]), str(self.inst[taxid]))
+        self.assertEqual(r['2'].genus, ['genusname'])
+        self.assertEqual(r.depth('2'), 4)
+        self.assertRaises(KeyError, r.__getitem__, '99')
+
+    def test_from_arrays_uses_exported_tree(self):
+        arrays = self.inst.to_arrays()
+        with patch('blasttax.build_children') as children, \
+                patch('blasttax.compute_depths') as depths:
+            r = blasttax.Phylogony.from_arrays(arrays)
+            self.assertEqual(r.depth('2'), 4)
+            self.assertEqual(r.lca('2', '6'), '1')
+            self.assertFalse(children.called or depths.called)
+        self.assertEqual(sorted(r.children['1']), ['5', '6'])
+        self.assertEqual(r.depths, self.inst.depths)
+
+    def test_npz_roundtrip(self):
+        path = os.path.join(self.tempdir, 'taxonomy.npz')
+        blasttax.main(['npz'] + self.dmps + [path])
+        r = blasttax.Phylogony.load_npz(path)
+        self.assertEqual(str(r['2']), str(self.inst['2']))
+        self.assertEqual(r.nodeindex['4'][0].division, '0')
+        self.assertEqual(r.divindex['0'][0].code, 'BCT')
+
+class TestExportLineages(TempdirTestCase):
+    def setUp(self):
+        super(TestExportLineages, self).setUp()
+        self.dmps = write_dmp_files(
+            self.tempdir, names=synonym_first_names_dmp
+        )
+        self.inst = blasttax.Phylogony(*self.dmps)
+
+    def export(self, **kwargs):
+        out = io.BytesIO()
+        blasttax.export_lineages(self.inst, out, **kwargs)
+        return out.getvalue()
+
+    def rows(self, data):
+        return [line.split('\t') for line in data.decode('utf-8').splitlines()]
+
+    def test_header_and_order(self):
+        rows = self.rows(self.export())
+        self.assertEqual(
+            rows[0][:4] + rows[0][-1:],
+            ['#taxid', 'name', 'rank', 'superkingdom', 'lineage']
+        )
+        self.assertEqual(
+            [row[0] for row in rows[1:]], ['1', '5', '4', '3', '2', '6']
+        )
+
+    def test_ranked_columns(self):
+        rows = dict((row[0], row) for row in self.rows(self.export()))
+        self.assertEqual(
+            rows['2'],
+            ['2', 'Bacteria', 'species', '', '', '', '', 'ordername',
+             'familyname', 'genusname', 'Bacteria',
+             'familyname;ordername;genusname;Bacteria']
+        )
+        self.assertEqual(rows['1'][-1], '')
+
+    def test_matches_per_taxid_lineages(self):
+        formatter = blasttax.LineageFormatter(self.inst, 'tsv')
+        # Skips the header and the root
+        for row in self.rows(self.export())[2:]:
+            expected = formatter.format(row[0]).decode('utf-8').split('\t')
+            self.assertEqual(row[-1], expected[3])
+
+    def test_gzip_chunks(self):
+        plain = self.export()
+        data = self.export(compress=True, threads=2, chunkrows=2)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(data)).read(), plain)
+
+    def test_lineages_command(self):
+        path = os.path.join(self.tempdir, 'lineages.tsv.gz')
+        blasttax.main(['lineages'] + self.dmps + ['-o', path])
+        with gzip.open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), self.export())